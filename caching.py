@@ -0,0 +1,303 @@
+import os
+import copy
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import msgspec
+
+logger = logging.getLogger('helpers')
+
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 10000))
+CACHE_DEFAULT_TTL = int(os.getenv('CACHE_DEFAULT_TTL', 300))
+REDIS_KEY_PREFIX = os.getenv('REDIS_KEY_PREFIX', 'moodwave:')
+# Longest a value read from or written to Redis is kept in the in-process tier, so writes
+# from other workers become visible
+CACHE_LOCAL_MAX_TTL = int(os.getenv('CACHE_LOCAL_MAX_TTL', 60))
+
+# Returned by get() on a miss so that falsy values can still be cached
+MISSING = object()
+
+class TTLCache:
+    """Thread-safe in-process cache with per-entry TTL, LRU eviction and per-namespace keys.
+
+    Keys live in namespaces (e.g. "user:<id>" or "search") so per-user data never collides
+    and can be dropped together. Hits, misses, expirations and evictions are counted.
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, default_ttl=CACHE_DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def get(self, key, namespace=None, default=MISSING):
+        """Return the cached value, or default if it is missing or expired."""
+        full_key = (namespace, key)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(full_key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= now:
+                del self._entries[full_key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(full_key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, namespace=None):
+        """Store a value for ttl seconds, evicting the least recently used entries when full."""
+        full_key = (namespace, key)
+        expires_at = time.time() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[full_key] = (value, expires_at)
+            self._entries.move_to_end(full_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def ttl_remaining(self, key, namespace=None):
+        """Return the seconds left before the entry expires, or None if it is not cached."""
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+        if entry is None:
+            return None
+        remaining = entry[1] - time.time()
+        return remaining if remaining > 0 else None
+
+    def delete(self, key, namespace=None):
+        with self._lock:
+            self._entries.pop((namespace, key), None)
+
+    def clear_namespace(self, namespace):
+        """Drop every entry in a namespace, e.g. all cached data for one user."""
+        with self._lock:
+            for full_key in [full_key for full_key in self._entries if full_key[0] == namespace]:
+                del self._entries[full_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'expirations': self.expirations,
+                'evictions': self.evictions
+            }
+
+class RedisCache:
+    """Shared cache tier on Redis with the same interface as TTLCache.
+
+    Values are msgpack-encoded with msgspec and expire through Redis' own TTLs. Any Redis
+    error is logged and treated as a miss, so an outage degrades to the in-process tier.
+    """
+
+    def __init__(self, client, prefix=REDIS_KEY_PREFIX, default_ttl=CACHE_DEFAULT_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _key(self, key, namespace):
+        return f"{self.prefix}{namespace}|{key!r}"
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key, namespace=None, default=MISSING):
+        try:
+            raw = self.client.get(self._key(key, namespace))
+        except Exception as e:
+            logger.warning(f"Redis cache get failed: {str(e)}")
+            self._count('errors')
+            return default
+        if raw is None:
+            self._count('misses')
+            return default
+        self._count('hits')
+        return msgspec.msgpack.decode(raw)
+
+    def set(self, key, value, ttl=None, namespace=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        try:
+            self.client.set(self._key(key, namespace), msgspec.msgpack.encode(value), px=int(ttl * 1000))
+        except Exception as e:
+            logger.warning(f"Redis cache set failed: {str(e)}")
+            self._count('errors')
+
+    def ttl_remaining(self, key, namespace=None):
+        try:
+            remaining = self.client.pttl(self._key(key, namespace))
+        except Exception as e:
+            logger.warning(f"Redis cache ttl lookup failed: {str(e)}")
+            self._count('errors')
+            return None
+        return remaining / 1000 if remaining and remaining > 0 else None
+
+    def delete(self, key, namespace=None):
+        try:
+            self.client.delete(self._key(key, namespace))
+        except Exception as e:
+            logger.warning(f"Redis cache delete failed: {str(e)}")
+            self._count('errors')
+
+    def clear_namespace(self, namespace):
+        try:
+            keys = list(self.client.scan_iter(match=f"{self.prefix}{namespace}|*"))
+            if keys:
+                self.client.delete(*keys)
+        except Exception as e:
+            logger.warning(f"Redis cache clear failed: {str(e)}")
+            self._count('errors')
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'errors': self.errors
+            }
+
+class TieredCache:
+    """In-process TTLCache in front of a shared RedisCache.
+
+    Local hits skip the network; local misses fall through to Redis and are copied into the
+    local tier for no longer than their remaining Redis TTL, so a value never outlives its
+    shared copy. Local copies are also capped at local_max_ttl.
+    """
+
+    def __init__(self, local, shared, local_max_ttl=CACHE_LOCAL_MAX_TTL):
+        self.local = local
+        self.shared = shared
+        self.local_max_ttl = local_max_ttl
+
+    def get(self, key, namespace=None, default=MISSING):
+        value = self.local.get(key, namespace=namespace)
+        if value is not MISSING:
+            return value
+        value = self.shared.get(key, namespace=namespace)
+        if value is MISSING:
+            return default
+        remaining = self.shared.ttl_remaining(key, namespace=namespace)
+        if remaining:
+            self.local.set(key, value, ttl=min(remaining, self.local_max_ttl), namespace=namespace)
+        return value
+
+    def set(self, key, value, ttl=None, namespace=None):
+        ttl = self.local.default_ttl if ttl is None else ttl
+        self.shared.set(key, value, ttl=ttl, namespace=namespace)
+        self.local.set(key, value, ttl=min(ttl, self.local_max_ttl), namespace=namespace)
+
+    def ttl_remaining(self, key, namespace=None):
+        return self.shared.ttl_remaining(key, namespace=namespace) or self.local.ttl_remaining(key, namespace=namespace)
+
+    def delete(self, key, namespace=None):
+        self.shared.delete(key, namespace=namespace)
+        self.local.delete(key, namespace=namespace)
+
+    def clear_namespace(self, namespace):
+        self.shared.clear_namespace(namespace)
+        self.local.clear_namespace(namespace)
+
+    def stats(self):
+        return {'local': self.local.stats(), 'shared': self.shared.stats()}
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into one execution.
+
+    The first caller runs the function; callers arriving while it is in flight wait and
+    receive a deep copy of its result, or the same exception.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {'executed': self.executed, 'coalesced': self.coalesced, 'in_flight': len(self._calls)}
+
+def connect_redis(url=None):
+    """Return a connected Redis client for url (default REDIS_URL), or None if Redis is not configured or reachable."""
+    url = url or os.getenv('REDIS_URL')
+    if not url:
+        return None
+    try:
+        import redis
+        client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        client.ping()
+        return client
+    except ImportError:
+        logger.warning("REDIS_URL is set but the redis package is not installed")
+    except Exception as e:
+        logger.warning(f"Could not connect to Redis at {url}: {str(e)}")
+    return None
+
+def build_cache(redis_client=None):
+    """Build the helpers' cache: tiered over Redis when available, otherwise in-process only."""
+    redis_client = redis_client or connect_redis()
+    if redis_client is None:
+        logger.info("Using in-process cache only")
+        return TTLCache()
+    logger.info("Using in-process cache backed by Redis")
+    return TieredCache(TTLCache(), RedisCache(redis_client))
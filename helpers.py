@@ -3,10 +3,16 @@ import json
 import random
 import re
 import time
+import asyncio
+import hashlib
 import logging
+import threading
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 
+import msgspec
+import numpy as np
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from spotipy.exceptions import SpotifyException
@@ -15,6 +21,13 @@ from wtforms import StringField, SubmitField, SelectField, HiddenField, TextArea
 from wtforms.validators import DataRequired, NumberRange
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
+from caching import build_cache, MISSING, SingleFlight
+from stores import PlaylistIndexStore, AudioFeaturesStore, TrackResolutionStore
+from spotify_async import run_async, submit_async
+from ratelimit import spotify_limiter, spotify_concurrency, retry_after_seconds, SPOTIFY_MAX_CONCURRENCY
+from records import track_record_from_spotify, audio_analysis_from_dict, RecommendedTrack, Recommendations
+from matching import TrackPoolIndex, resolution_key
+
 
 # Set up logging
 log_directory = "logs"
@@ -50,8 +63,52 @@ console_handler.setFormatter(formatter)
 helper_logger.addHandler(file_handler)
 helper_logger.addHandler(console_handler)
 
-# Cache to store API responses
-cache = {}
+# Cache to store API responses, namespaced per user ("user:<id>") or per shared data type
+cache = build_cache()
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60 * 60))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', 60 * 60))
+# Model answers for an identical prompt are reused for this long unless the user asks to regenerate
+RECOMMENDATION_CACHE_TTL = int(os.getenv('RECOMMENDATION_CACHE_TTL', 60 * 60))
+RECOMMENDATION_MODEL = "gpt-4"
+# Ask for a bare JSON object (response_format json_object); needs a model that supports JSON mode
+OPENAI_JSON_MODE = os.getenv('OPENAI_JSON_MODE', '').lower() in ('1', 'true', 'yes')
+# Seconds to wait on the model before giving up (callers fall back to the local ranker)
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 60))
+# 'text' asks for track names; 'ids' sends the pool as a numbered table and takes pool picks back by number
+RECOMMENDATION_PROMPT_MODE = os.getenv('RECOMMENDATION_PROMPT_MODE', 'text')
+
+# Artist metadata shared by scoring and the preference pages
+ARTIST_CACHE_TTL = 24 * 60 * 60
+ARTIST_BATCH_SIZE = 50
+ALBUM_BATCH_SIZE = 20
+TOP_ARTISTS_LIMIT = 50
+
+# Server-side playlist membership index, refreshed per playlist snapshot
+playlist_index_store = PlaylistIndexStore()
+
+# Audio features persisted by track id so each track is only ever fetched once
+AUDIO_FEATURES_BATCH_SIZE = 100
+audio_features_store = AudioFeaturesStore()
+
+# Recommendation (title, artist) to track id resolutions, shared by every user and worker
+# SQLite keeps resolutions across restarts; the cache's Redis tier shares them between hosts
+track_resolution_store = TrackResolutionStore(cache=cache)
+
+# User-independent candidate sources (new releases, new artists) shared by every session
+# and worker through the cache, keyed by market and refreshed in the background. Entries
+# outlive their refresh interval so stale data can be served while a refresh runs.
+CANDIDATE_REFRESH_INTERVAL = int(os.getenv('CANDIDATE_REFRESH_INTERVAL', 6 * 60 * 60))
+CANDIDATE_CACHE_TTL = CANDIDATE_REFRESH_INTERVAL * 4
+candidate_markets = set()
+candidate_refreshing = set()
+candidate_refresh_lock = threading.Lock()
+
+# Bounded worker pools for Spotify fan-out. Whole sources run on source_executor and may
+# fan individual requests out to request_executor; request tasks never submit further
+# work, so neither pool can end up waiting on itself. request_executor is sized to the
+# ceiling of spotify_concurrency, which sets how many requests are actually in flight.
+source_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='spotify-source')
+request_executor = ThreadPoolExecutor(max_workers=SPOTIFY_MAX_CONCURRENCY, thread_name_prefix='spotify-request')
 
 class PlaylistForm(FlaskForm):
     name = StringField('Name')
@@ -67,16 +124,24 @@ class PlaylistForm(FlaskForm):
     playlist_description = TextAreaField('Playlist Description')
     submit = SubmitField('Generate Playlist')
 
-def cached_request(key, ttl_seconds, fetch_function, *args, **kwargs):
+def cached_request(key, ttl_seconds, fetch_function, *args, namespace=None, **kwargs):
     """Cache the result of a function call for a specified time to reduce redundant API requests."""
-    current_time = time.time()
-    if key in cache and current_time - cache[key]['timestamp'] < ttl_seconds:
-        return cache[key]['data']
-    
-    data = fetch_function(*args, **kwargs)
-    cache[key] = {'data': data, 'timestamp': current_time}
+    data = cache.get(key, namespace=namespace)
+    if data is MISSING:
+        data = fetch_function(*args, **kwargs)
+        cache.set(key, data, ttl=ttl_seconds, namespace=namespace)
     return data
 
+def token_cache_key(sp):
+    """Return a cache key for the access token a Spotify client uses, or None if it has none."""
+    token = getattr(sp, '_auth', None)
+    return hashlib.sha256(token.encode()).hexdigest()[:32] if token else None
+
+def user_cache_namespace(sp):
+    """Return the cache namespace for the user behind a Spotify client, or None if unknown."""
+    profile = get_user_profile(sp)
+    return f"user:{profile['id']}" if profile else None
+
 def get_playlist_picks(sp, limit=10, max_playlist_age_days=365):
     """Retrieve tracks from the user's less frequently listened to playlists."""
     helper_logger.debug(f"Fetching playlist picks. Limit: {limit}, Max age: {max_playlist_age_days} days")
@@ -262,89 +327,392 @@ def fill_with_random_tracks(sp, playlists, playlist_picks, limit):
     
     return playlist_picks
 
+# Concurrent identical read requests for the same user share one in-flight Spotify call
+spotify_single_flight = SingleFlight()
+SPOTIFY_WRITE_VERBS = frozenset(['add', 'create', 'delete', 'remove', 'save', 'follow', 'unfollow',
+                                 'reorder', 'replace', 'change', 'upload', 'start', 'pause', 'seek',
+                                 'repeat', 'shuffle', 'transfer', 'volume'])
+
+def is_spotify_throttle(exception):
+    """Return True for errors that mean Spotify wants less traffic: 429s and 5xx responses."""
+    return isinstance(exception, SpotifyException) and (exception.http_status == 429 or exception.http_status >= 500)
+
+_spotify_backoff = wait_exponential(multiplier=1, min=4, max=60)
+
+def wait_for_spotify_retry(retry_state):
+    """Retry 429s immediately, since spotify_limiter already holds the retry back for Retry-After; back off on other errors."""
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, SpotifyException) and exception.http_status == 429:
+        return 0
+    return _spotify_backoff(retry_state)
+
 @retry(
     stop=stop_after_attempt(5),
-    wait=wait_exponential(multiplier=1, min=4, max=60),
+    wait=wait_for_spotify_retry,
     retry=retry_if_exception_type(SpotifyException)
 )
-def make_spotify_request_with_retry(sp, method, *args, **kwargs):
+def _spotify_request_with_retry(sp, method, *args, **kwargs):
     """Make a Spotify API request with retries and exponential backoff."""
     try:
-        return getattr(sp, method)(*args, **kwargs)
+        # Each attempt holds a concurrency slot only while the call is in flight, not while backing off
+        with spotify_concurrency.slot(is_spotify_throttle):
+            return getattr(sp, method)(*args, **kwargs)
     except SpotifyException as e:
         if e.http_status == 429:
-            retry_after = int(e.headers.get('Retry-After', 1))
-            helper_logger.warning(f"Rate limited. Waiting for {retry_after} seconds before retrying.")
-            time.sleep(retry_after)
+            # Clients built on spotify_requests_session have paused already; pausing again is harmless
+            spotify_limiter.pause(retry_after_seconds(e.headers or {}))
         helper_logger.error(f"Spotify API error: {e}")
         raise
-    
-def get_openai_recommendations(client, user_preferences, tracks, num_tracks=30):
-    """Generate playlist recommendations using OpenAI based on user preferences and available tracks."""
-    try:
-        familiar_tracks = [t for t in tracks if t.get('familiarity', 0) > 0.5]
-        discovery_tracks = [t for t in tracks if t.get('familiarity', 0) <= 0.5]
-
-        familiar_track_info = [f"{track['name']} by {', '.join([artist['name'] for artist in track['artists']])}" for track in familiar_tracks[:50]]
-        discovery_track_info = [f"{track['name']} by {', '.join([artist['name'] for artist in track['artists']])}" for track in discovery_tracks[:50]]
-
-        prompt = f"""
-        As a music expert AI assistant, create a personalized playlist based on the following preferences:
-        - Current mood: {user_preferences['current_mood']} (0-100, where 0 is very negative and 100 is very positive)
-        - Desired mood: {user_preferences['desired_mood']} (0-100, same scale as current mood)
-        - Activity: {user_preferences['activity']}
-        - Energy level: {user_preferences['energy_level']} (0-100, where 0 is very low energy and 100 is very high energy)
-        - Time of day: {user_preferences['time_of_day']}
-        - Discovery level: {user_preferences['discovery_level']} (0 = only familiar tracks, 1 = maximum discovery)
-        - Playlist description: {user_preferences['playlist_description']}
-
-        Provide a list of {num_tracks} tracks that best match these preferences, considering both familiar and discovery tracks.
-        The response should be in the following JSON format:
-
-        ```json
-        {{
-            "playlist_description": "A brief description of the playlist, explaining how it meets the user's preferences",
-            "tracks": [
-                {{
-                    "name": "Track Name",
-                    "artist": "Artist Name",
-                    "reason": "A brief explanation of why this track was chosen and how it fits the playlist"
-                }}
-            ]
-        }}
-        """
 
+def is_read_only_spotify_method(method):
+    """Return True for spotipy methods that only read data and are safe to coalesce."""
+    return not SPOTIFY_WRITE_VERBS.intersection(method.split('_'))
+
+def make_spotify_request_with_retry(sp, method, *args, **kwargs):
+    """Make a Spotify API request with retries and exponential backoff.
+
+    Identical read requests made at the same time for the same access token are coalesced
+    into one call whose result or error every caller receives.
+    """
+    if not is_read_only_spotify_method(method):
+        return _spotify_request_with_retry(sp, method, *args, **kwargs)
+    key = (token_cache_key(sp), method, repr(args), repr(sorted(kwargs.items())))
+    return spotify_single_flight.do(key, lambda: _spotify_request_with_retry(sp, method, *args, **kwargs))
+
+def run_spotify_requests(sp, calls):
+    """Run (method, args, kwargs) calls through make_spotify_request_with_retry on the request pool.
+
+    Results are returned in the order of calls, whatever order they complete in. A call
+    that fails is logged and its result is None, so one failed request only loses its own
+    items.
+    """
+    futures = [
+        request_executor.submit(make_spotify_request_with_retry, sp, method, *args, **kwargs)
+        for method, args, kwargs in calls
+    ]
+    results = []
+    for (method, args, kwargs), future in zip(calls, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            logger.error(f"Error in Spotify request {method}: {str(e)}")
+            results.append(None)
+    return results
+
+async def gather_spotify_requests(*requests):
+    """Async run_spotify_requests: await AsyncSpotify calls together; a failed call is logged and gives None."""
+    results = await asyncio.gather(*requests, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Error in Spotify request: {str(result)}")
+    return [None if isinstance(result, Exception) else result for result in results]
+
+def select_prompt_tracks(tracks):
+    """Split the tracks the recommendation prompt is built from into (familiar, discovery).
+
+    A track is familiar when its discovery_score is at most 0.5. The list is expected to
+    be budgeted already (prefilter_prompt_tracks), so every track is kept, in order.
+    """
+    familiar_tracks, discovery_tracks = [], []
+    for track in tracks:
+        score = track.discovery_score if track.discovery_score is not None else 0.5
+        (familiar_tracks if score <= 0.5 else discovery_tracks).append(track)
+    return familiar_tracks, discovery_tracks
+
+def prompt_track_numbers(tracks):
+    """Map the short numbers used in the 'ids' prompt table to pool tracks."""
+    familiar_tracks, discovery_tracks = select_prompt_tracks(tracks)
+    return {number: track for number, track in enumerate(familiar_tracks + discovery_tracks, start=1)}
+
+def prompt_track_table(tracks):
+    """Render the pool as a compact numbered table for the 'ids' prompt."""
+    lines = ["n|title|artist|energy|happiness|bpm|discovery"]
+    for number, track in prompt_track_numbers(tracks).items():
+        analysis = track.audio_analysis
+        features = (
+            f"{analysis.energy:.0f}|{analysis.happiness:.0f}|{analysis.tempo:.0f}" if analysis else "-|-|-"
+        )
+        discovery = f"{track.discovery_score * 100:.0f}" if track.discovery_score is not None else "-"
+        lines.append(f"{number}|{track.name}|{track.artist}|{features}|{discovery}")
+    return "\n".join(lines)
+
+def expand_prompt_track(track, numbers):
+    """Turn an {"id": n} pool pick into a full recommendation carrying its Spotify id.
+
+    Returns None for a number that is not in the table; suggestions given by name pass
+    through unchanged.
+    """
+    if track.get('id') is None:
+        return track
+    try:
+        pooled = numbers.get(int(str(track['id']).lstrip('#')))
+    except ValueError:
+        pooled = None
+    if pooled is None:
+        if track.get('name'):
+            return track
+        logger.warning(f"Model picked unknown pool track {track['id']}")
+        return None
+    return {'name': pooled.name, 'artist': pooled.artist, 'reason': track.get('reason', ''), 'spotify_id': pooled.id}
+
+def expand_prompt_tracks(recommended_tracks, pool_tracks):
+    """Apply expand_prompt_track to a parsed recommendation list."""
+    numbers = prompt_track_numbers(pool_tracks or [])
+    expanded = [expand_prompt_track(track, numbers) for track in recommended_tracks]
+    return [track for track in expanded if track is not None]
+
+def recommendation_cache_key(user_preferences, tracks, num_tracks=30):
+    """Fingerprint of everything that shapes the recommendation prompt."""
+    familiar_tracks, discovery_tracks = select_prompt_tracks(tracks)
+    fingerprint = json.dumps({
+        'model': RECOMMENDATION_MODEL,
+        'prompt_mode': RECOMMENDATION_PROMPT_MODE,
+        'user_preferences': user_preferences,
+        'num_tracks': num_tracks,
+        'familiar_track_ids': [track.id for track in familiar_tracks],
+        'discovery_track_ids': [track.id for track in discovery_tracks]
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+def cache_recommendations(key, response):
+    """Cache a model answer under its prompt fingerprint if it contains any tracks."""
+    if response and IncrementalTrackParser().feed(response):
+        cache.set(key, response, ttl=RECOMMENDATION_CACHE_TTL, namespace='recommendations')
+
+def recommendation_request_options():
+    """Extra chat.completions.create arguments shared by the blocking and streaming calls."""
+    options = {'timeout': OPENAI_TIMEOUT}
+    if OPENAI_JSON_MODE:
+        options['response_format'] = {'type': 'json_object'}
+    return options
+
+def build_id_recommendation_prompt(user_preferences, tracks, num_tracks=30):
+    """Prompt for the 'ids' mode: the pool as a numbered table, pool picks answered by number."""
+    return f"""
+    As a music expert AI assistant, create a personalized playlist based on the following preferences:
+    - Current mood: {user_preferences['current_mood']} (0-100, where 0 is very negative and 100 is very positive)
+    - Desired mood: {user_preferences['desired_mood']} (0-100, same scale as current mood)
+    - Activity: {user_preferences['activity']}
+    - Energy level: {user_preferences['energy_level']} (0-100, where 0 is very low energy and 100 is very high energy)
+    - Time of day: {user_preferences['time_of_day']}
+    - Discovery level: {user_preferences['discovery_level']} (0 = only familiar tracks, 1 = maximum discovery)
+    - Playlist description: {user_preferences['playlist_description']}
+
+    Candidate tracks (energy, happiness and discovery are 0-100; higher discovery means less familiar to the user):
+{prompt_track_table(tracks)}
+
+    Provide a list of {num_tracks} tracks that best match these preferences, preferring candidates.
+    Refer to a candidate by its number n only. Add a track that is not a candidate by name and artist.
+    The response should be in the following JSON format:
+
+    ```json
+    {{
+        "playlist_description": "A brief description of the playlist, explaining how it meets the user's preferences",
+        "tracks": [
+            {{"id": 12, "reason": "A brief reason"}},
+            {{"name": "Track Name", "artist": "Artist Name", "reason": "A brief reason"}}
+        ]
+    }}
+    """
+
+def build_recommendation_messages(user_preferences, tracks, num_tracks=30):
+    """Build the chat messages asking the model for a playlist."""
+    if RECOMMENDATION_PROMPT_MODE == 'ids':
+        return [
+            {"role": "system", "content": "You are a music expert AI assistant, skilled in creating personalized playlists."},
+            {"role": "user", "content": build_id_recommendation_prompt(user_preferences, tracks, num_tracks)}
+        ]
+
+    familiar_tracks, discovery_tracks = select_prompt_tracks(tracks)
+
+    familiar_track_info = [f"{track.name} by {', '.join(track.artist_names)}" for track in familiar_tracks]
+    discovery_track_info = [f"{track.name} by {', '.join(track.artist_names)}" for track in discovery_tracks]
+    familiar_track_list = "\n    ".join(familiar_track_info) or "None"
+    discovery_track_list = "\n    ".join(discovery_track_info) or "None"
+
+    prompt = f"""
+    As a music expert AI assistant, create a personalized playlist based on the following preferences:
+    - Current mood: {user_preferences['current_mood']} (0-100, where 0 is very negative and 100 is very positive)
+    - Desired mood: {user_preferences['desired_mood']} (0-100, same scale as current mood)
+    - Activity: {user_preferences['activity']}
+    - Energy level: {user_preferences['energy_level']} (0-100, where 0 is very low energy and 100 is very high energy)
+    - Time of day: {user_preferences['time_of_day']}
+    - Discovery level: {user_preferences['discovery_level']} (0 = only familiar tracks, 1 = maximum discovery)
+    - Playlist description: {user_preferences['playlist_description']}
+
+    Familiar tracks from the user's listening:
+    {familiar_track_list}
+
+    Discovery tracks the user may not know yet:
+    {discovery_track_list}
+
+    Provide a list of {num_tracks} tracks that best match these preferences, considering both familiar and discovery tracks.
+    The response should be in the following JSON format:
+
+    ```json
+    {{
+        "playlist_description": "A brief description of the playlist, explaining how it meets the user's preferences",
+        "tracks": [
+            {{
+                "name": "Track Name",
+                "artist": "Artist Name",
+                "reason": "A brief explanation of why this track was chosen and how it fits the playlist"
+            }}
+        ]
+    }}
+    """
+
+    return [
+        {"role": "system", "content": "You are a music expert AI assistant, skilled in creating personalized playlists."},
+        {"role": "user", "content": prompt}
+    ]
+
+def get_openai_recommendations(client, user_preferences, tracks, num_tracks=30, regenerate=False):
+    """Generate playlist recommendations using OpenAI based on user preferences and available tracks.
+
+    Answers are cached by prompt fingerprint; regenerate=True skips the cached answer.
+    """
+    key = recommendation_cache_key(user_preferences, tracks, num_tracks)
+    if not regenerate:
+        response = cache.get(key, namespace='recommendations')
+        if response is not MISSING:
+            logger.info("Using cached OpenAI recommendations")
+            return response
+    try:
         response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a music expert AI assistant, skilled in creating personalized playlists."},
-                {"role": "user", "content": prompt}
-            ]
+            model=RECOMMENDATION_MODEL,
+            messages=build_recommendation_messages(user_preferences, tracks, num_tracks),
+            **recommendation_request_options()
         )
 
-        return response.choices[0].message.content
+        content = response.choices[0].message.content
+        if response.choices[0].finish_reason == 'length':
+            logger.warning("OpenAI response was cut off at the token limit; complete tracks will be salvaged")
+        cache_recommendations(key, content)
+        return content
     except Exception as e:
         logger.error(f"Error in get_openai_recommendations: {str(e)}")
         return None
 
+def stream_openai_recommendations(client, user_preferences, tracks, num_tracks=30, regenerate=False):
+    """Yield the text of the recommendation completion piece by piece as the model produces it.
+
+    A cached answer for the same prompt is yielded whole unless regenerate=True; a fully
+    streamed answer is cached.
+    """
+    key = recommendation_cache_key(user_preferences, tracks, num_tracks)
+    if not regenerate:
+        response = cache.get(key, namespace='recommendations')
+        if response is not MISSING:
+            logger.info("Using cached OpenAI recommendations")
+            yield response
+            return
+
+    stream = client.chat.completions.create(
+        model=RECOMMENDATION_MODEL,
+        messages=build_recommendation_messages(user_preferences, tracks, num_tracks),
+        stream=True,
+        **recommendation_request_options()
+    )
+    pieces = []
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            pieces.append(chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+    cache_recommendations(key, ''.join(pieces))
+
 def get_user_profile(sp):
     """Fetch the user's Spotify profile."""
+    token_key = token_cache_key(sp)
+    if token_key:
+        profile = cache.get(token_key, namespace='profiles')
+        if profile is not MISSING:
+            return profile
     try:
         helper_logger.debug("Fetching user profile")
-        profile = sp.me()
+        profile = make_spotify_request_with_retry(sp, 'me')
         helper_logger.debug(f"User profile fetched successfully: {profile['id']}")
+        if token_key:
+            cache.set(token_key, profile, ttl=USER_CACHE_TTL, namespace='profiles')
         return profile
     except Exception as e:
         helper_logger.error(f"Error fetching user profile: {str(e)}")
         return None
 
+def cache_artists(artists):
+    """Store full Spotify artist objects in the artist metadata cache."""
+    for artist in artists:
+        if artist and artist.get('id'):
+            cache.set(artist['id'], {
+                'id': artist['id'],
+                'name': artist.get('name'),
+                'popularity': artist.get('popularity'),
+                'genres': artist.get('genres', [])
+            }, ttl=ARTIST_CACHE_TTL, namespace='artists')
+
+def get_artists_metadata(sp, artist_ids):
+    """Return {artist_id: metadata} for the given ids, fetching cache misses through the batch artists endpoint."""
+    artist_ids = list(dict.fromkeys(artist_id for artist_id in artist_ids if artist_id))
+    metadata = {}
+    missing = []
+    for artist_id in artist_ids:
+        entry = cache.get(artist_id, namespace='artists')
+        if entry is MISSING:
+            missing.append(artist_id)
+        else:
+            metadata[artist_id] = entry
+
+    for i in range(0, len(missing), ARTIST_BATCH_SIZE):
+        batch = missing[i:i+ARTIST_BATCH_SIZE]
+        try:
+            artists = make_spotify_request_with_retry(sp, 'artists', batch)['artists']
+            cache_artists(artists)
+            for artist in artists:
+                if artist and artist.get('id'):
+                    metadata[artist['id']] = cache.get(artist['id'], namespace='artists', default=None)
+            helper_logger.debug(f"Fetched metadata for {len(batch)} artists in batch {i // ARTIST_BATCH_SIZE + 1}")
+        except Exception as e:
+            helper_logger.error(f"Error fetching artist metadata batch {i // ARTIST_BATCH_SIZE + 1}: {str(e)}")
+
+    return {artist_id: info for artist_id, info in metadata.items() if info}
+
+def get_artist_metadata(sp, artist_id):
+    """Return cached metadata for a single artist, or None if it cannot be fetched."""
+    return get_artists_metadata(sp, [artist_id]).get(artist_id)
+
+def get_top_artist_items(sp, limit=TOP_ARTISTS_LIMIT):
+    """Return the user's top artist objects, cached per user.
+
+    The top TOP_ARTISTS_LIMIT artists are fetched once and smaller limits are served from
+    the front of that list, since Spotify returns them in rank order.
+    """
+    def fetch():
+        top_artists = make_spotify_request_with_retry(sp, 'current_user_top_artists', limit=TOP_ARTISTS_LIMIT)['items']
+        cache_artists(top_artists)
+        return top_artists
+
+    namespace = user_cache_namespace(sp)
+    if namespace is None:
+        top_artists = fetch()
+    else:
+        top_artists = cached_request('top_artists', USER_CACHE_TTL, fetch, namespace=namespace)
+    return top_artists[:limit]
+
 def get_user_top_artists(sp, limit=10):
     """Fetch the user's top artists."""
     try:
         helper_logger.debug(f"Fetching user's top {limit} artists")
-        top_artists = sp.current_user_top_artists(limit=limit)
-        helper_logger.debug(f"Successfully fetched {len(top_artists['items'])} top artists")
-        return [{"name": artist['name'], "id": artist['id']} for artist in top_artists['items']]
+        top_artists = get_top_artist_items(sp, limit=limit)
+        helper_logger.debug(f"Successfully fetched {len(top_artists)} top artists")
+        return [
+            {
+                "name": artist['name'],
+                "id": artist['id'],
+                "popularity": artist.get('popularity'),
+                "genres": artist.get('genres', [])
+            }
+            for artist in top_artists
+        ]
     except Exception as e:
         helper_logger.error(f"Error fetching top artists: {str(e)}")
         return []
@@ -353,8 +721,9 @@ def get_user_top_genres(sp, limit=10):
     """Fetch the user's top genres."""
     try:
         helper_logger.debug("Fetching user's top genres")
-        top_artists = sp.current_user_top_artists(limit=50)
-        genres = [genre for artist in top_artists['items'] for genre in artist['genres']]
+        top_artists = get_top_artist_items(sp)
+        artist_metadata = get_artists_metadata(sp, [artist['id'] for artist in top_artists])
+        genres = [genre for artist in artist_metadata.values() for genre in artist['genres']]
         genre_counts = Counter(genres)
         top_genres = [{"name": genre, "count": count} for genre, count in genre_counts.most_common(limit)]
         helper_logger.debug(f"Successfully fetched {len(top_genres)} top genres")
@@ -363,18 +732,41 @@ def get_user_top_genres(sp, limit=10):
         helper_logger.error(f"Error fetching top genres: {str(e)}")
         return []
 
+def pool_track_fields(track):
+    """The parts of a Spotify track object that pool building reads (see track_record_from_spotify)."""
+    return {
+        'id': track['id'],
+        'name': track.get('name', ''),
+        'artists': [{'id': artist.get('id'), 'name': artist.get('name', '')} for artist in track.get('artists') or []],
+        'popularity': track.get('popularity'),
+        'duration_ms': track.get('duration_ms'),
+        'preview_url': track.get('preview_url')
+    }
+
+def cached_track_searches(sp, queries, limit=10):
+    """Run track searches, serving repeats from the shared search cache.
+
+    Returns one list of trimmed tracks (pool_track_fields) per query, in query order, or
+    None for a search that failed. Only the trimmed tracks are cached, not the raw response.
+    """
+    results = [cache.get((query, limit), namespace='search_tracks') for query in queries]
+    misses = [i for i, result in enumerate(results) if result is MISSING]
+    fetched = run_spotify_requests(sp, [('search', (), {'q': queries[i], 'type': 'track', 'limit': limit}) for i in misses])
+    for i, result in zip(misses, fetched):
+        if result is not None:
+            result = [pool_track_fields(track) for track in result.get('tracks', {}).get('items', []) if track and track.get('id')]
+            cache.set((queries[i], limit), result, ttl=SEARCH_CACHE_TTL, namespace='search_tracks')
+        results[i] = result
+    return results
+
 def get_tracks_from_favorites(sp, favorite_artists, favorite_genres, limit=50):
     """Fetch tracks based on the user's favorite artists and genres."""
     tracks = []
     try:
-        for artist in favorite_artists:
-            results = make_spotify_request_with_retry(sp, 'search', q=f'artist:{artist}', type='track', limit=10)
-            if 'tracks' in results and 'items' in results['tracks']:
-                tracks.extend(results['tracks']['items'])
-        for genre in favorite_genres:
-            results = make_spotify_request_with_retry(sp, 'search', q=f'genre:{genre}', type='track', limit=10)
-            if 'tracks' in results and 'items' in results['tracks']:
-                tracks.extend(results['tracks']['items'])
+        queries = [f'artist:{artist}' for artist in favorite_artists] + [f'genre:{genre}' for genre in favorite_genres]
+        for results in cached_track_searches(sp, queries, limit=10):
+            if results:
+                tracks.extend(results)
         logger.debug(f"Fetched {len(tracks)} tracks from favorites")
         return tracks[:limit]
     except Exception as e:
@@ -384,62 +776,345 @@ def get_tracks_from_favorites(sp, favorite_artists, favorite_genres, limit=50):
 def get_user_top_and_recent_tracks(sp, limit=50):
     """Fetch the user's top and recent tracks."""
     try:
-        top_tracks = make_spotify_request_with_retry(sp, 'current_user_top_tracks', limit=limit)['items']
-        recent_tracks = make_spotify_request_with_retry(sp, 'current_user_recently_played', limit=limit)['items']
-        tracks = top_tracks + [item['track'] for item in recent_tracks]
+        top_tracks, recent_tracks = run_spotify_requests(sp, [
+            ('current_user_top_tracks', (), {'limit': limit}),
+            ('current_user_recently_played', (), {'limit': limit})
+        ])
+        tracks = (top_tracks or {}).get('items', []) + [item['track'] for item in (recent_tracks or {}).get('items', [])]
         logger.debug(f"Fetched {len(tracks)} top and recent tracks")
         return tracks[:limit]
     except Exception as e:
         logger.error(f"Error in get_user_top_and_recent_tracks: {str(e)}", exc_info=True)
         return []
 
-def get_new_releases(sp, limit=50):
+def get_new_releases(sp, limit=50, market=None):
     """Fetch new releases from Spotify."""
     try:
-        new_releases = make_spotify_request_with_retry(sp, 'new_releases', limit=limit)['albums']['items']
+        new_releases = make_spotify_request_with_retry(sp, 'new_releases', country=market, limit=limit)['albums']['items']
+        album_ids = [album['id'] for album in new_releases]
+        # Full album payloads include the first page of tracks, so 20 albums cost one call
+        album_batches = run_spotify_requests(sp, [
+            ('albums', (album_ids[i:i+ALBUM_BATCH_SIZE],), {'market': market}) for i in range(0, len(album_ids), ALBUM_BATCH_SIZE)
+        ])
         tracks = []
-        for album in new_releases:
-            album_tracks = make_spotify_request_with_retry(sp, 'album_tracks', album['id'])['items']
-            tracks.extend(album_tracks[:2])
+        for batch in album_batches:
+            if batch is None:
+                continue
+            for album in batch['albums']:
+                if album:
+                    tracks.extend(album['tracks']['items'][:2])
         logger.debug(f"Fetched {len(tracks)} tracks from new releases")
         return tracks[:limit]
     except Exception as e:
         logger.error(f"Error in get_new_releases: {str(e)}", exc_info=True)
         return []
 
-def get_new_artist_tracks(sp, limit=50):
+def get_new_artist_tracks(sp, limit=50, market=None):
     """Fetch tracks from new artists."""
     try:
-        search_results = make_spotify_request_with_retry(sp, 'search', q='year:2023', type='artist', limit=10)
+        search_results = make_spotify_request_with_retry(sp, 'search', q='year:2023', type='artist', limit=10, market=market)
         tracks = []
-        for artist in search_results['artists']['items']:
-            artist_top_tracks = make_spotify_request_with_retry(sp, 'artist_top_tracks', artist['id'])['tracks']
-            tracks.extend(artist_top_tracks[:2])
+        top_tracks = run_spotify_requests(sp, [
+            ('artist_top_tracks', (artist['id'],), {'country': market or 'US'}) for artist in search_results['artists']['items']
+        ])
+        for artist_top_tracks in top_tracks:
+            if artist_top_tracks is not None:
+                tracks.extend(artist_top_tracks['tracks'][:2])
         logger.debug(f"Fetched {len(tracks)} tracks from new artists")
         return tracks[:limit]
     except Exception as e:
         logger.error(f"Error in get_new_artist_tracks: {str(e)}", exc_info=True)
         return []
 
-def get_expanded_track_pool(sp, favorite_artists, favorite_genres, user_profile, discovery_ratio=0.3):
-    """Expand the pool of tracks to include familiar and discovery tracks."""
+def refresh_candidate_sources(sp, market):
+    """Fetch the user-independent candidate sources for a market into the shared cache.
+
+    A source that comes back empty (the fetchers return [] on errors) keeps its previous
+    tracks, so a failed refresh serves stale data instead of nothing.
+    """
+    try:
+        # Both fetchers fan their requests out to request_executor themselves, so they run
+        # inline here rather than as pool tasks waiting on the same pools
+        new_releases = get_new_releases(sp, market=market)
+        new_artist_tracks = get_new_artist_tracks(sp, market=market)
+
+        previous = cache.get(market, namespace='candidates', default={})
+        previous_data = previous.get('data', {})
+        cache.set(market, {
+            'data': {
+                'new_releases': new_releases or previous_data.get('new_releases', []),
+                'new_artist_tracks': new_artist_tracks or previous_data.get('new_artist_tracks', [])
+            },
+            'timestamp': time.time() if new_releases and new_artist_tracks else previous.get('timestamp', 0)
+        }, ttl=CANDIDATE_CACHE_TTL, namespace='candidates')
+        logger.debug(f"Refreshed candidate sources for market {market}: {len(new_releases)} new releases, {len(new_artist_tracks)} new artist tracks")
+    finally:
+        with candidate_refresh_lock:
+            candidate_refreshing.discard(market)
+
+def get_candidate_sources(sp, market):
+    """Return (new_releases, new_artist_tracks) for a market from the shared candidate cache.
+
+    Stale entries are served immediately while a background refresh runs. Only a market
+    missing from the cache is fetched inline. The lists are shared with the cache, so
+    callers must not modify them; pool building only reads them into TrackRecords.
+    """
+    entry = cache.get(market, namespace='candidates', default=None)
+    with candidate_refresh_lock:
+        candidate_markets.add(market)
+        needs_refresh = (entry is None or time.time() - entry['timestamp'] >= CANDIDATE_REFRESH_INTERVAL) and market not in candidate_refreshing
+        if needs_refresh:
+            candidate_refreshing.add(market)
+
+    if entry is None:
+        if needs_refresh:
+            refresh_candidate_sources(sp, market)
+        else:
+            # Another request is already fetching this market; fall back to a direct fetch
+            return get_new_releases(sp, market=market), get_new_artist_tracks(sp, market=market)
+        entry = cache.get(market, namespace='candidates', default=None)
+        if entry is None:
+            return [], []
+    elif needs_refresh:
+        logger.debug(f"Candidate sources for market {market} are stale, refreshing in the background")
+        source_executor.submit(refresh_candidate_sources, sp, market)
+
+    return entry['data']['new_releases'], entry['data']['new_artist_tracks']
+
+def start_candidate_refresher(sp_factory, markets, interval=CANDIDATE_REFRESH_INTERVAL):
+    """Start a daemon thread that keeps the candidate cache warm for the given markets.
+
+    sp_factory returns a Spotify client that does not depend on a user session, e.g. one
+    using client credentials. Markets first seen at request time are refreshed as well.
+    """
+    with candidate_refresh_lock:
+        candidate_markets.update(markets)
+
+    def refresh_loop():
+        while True:
+            with candidate_refresh_lock:
+                all_markets = set(candidate_markets)
+            for market in sorted(all_markets):
+                try:
+                    # Built before the market is claimed, so a failing factory cannot leave it
+                    # marked as refreshing; refresh_candidate_sources releases it from here on
+                    sp = sp_factory()
+                    with candidate_refresh_lock:
+                        if market in candidate_refreshing:
+                            continue
+                        candidate_refreshing.add(market)
+                    refresh_candidate_sources(sp, market)
+                except Exception as e:
+                    logger.error(f"Error refreshing candidate sources for market {market}: {str(e)}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=refresh_loop, name='candidate-refresher', daemon=True)
+    thread.start()
+    return thread
+
+async def get_user_profile_async(asp):
+    """Async get_user_profile for an AsyncSpotify client."""
+    try:
+        helper_logger.debug("Fetching user profile")
+        profile = await asp.me()
+        helper_logger.debug(f"User profile fetched successfully: {profile['id']}")
+        return profile
+    except Exception as e:
+        helper_logger.error(f"Error fetching user profile: {str(e)}")
+        return None
+
+async def get_user_top_artists_async(asp, limit=10):
+    """Async get_user_top_artists for an AsyncSpotify client."""
+    try:
+        helper_logger.debug(f"Fetching user's top {limit} artists")
+        top_artists = await asp.current_user_top_artists(limit=limit)
+        helper_logger.debug(f"Successfully fetched {len(top_artists['items'])} top artists")
+        cache_artists(top_artists['items'])
+        return [
+            {
+                "name": artist['name'],
+                "id": artist['id'],
+                "popularity": artist.get('popularity'),
+                "genres": artist.get('genres', [])
+            }
+            for artist in top_artists['items']
+        ]
+    except Exception as e:
+        helper_logger.error(f"Error fetching top artists: {str(e)}")
+        return []
+
+async def get_user_top_genres_async(asp, limit=10):
+    """Async get_user_top_genres for an AsyncSpotify client."""
+    try:
+        helper_logger.debug("Fetching user's top genres")
+        top_artists = await asp.current_user_top_artists(limit=50)
+        cache_artists(top_artists['items'])
+        genres = [genre for artist in top_artists['items'] for genre in artist.get('genres', [])]
+        genre_counts = Counter(genres)
+        top_genres = [{"name": genre, "count": count} for genre, count in genre_counts.most_common(limit)]
+        helper_logger.debug(f"Successfully fetched {len(top_genres)} top genres")
+        return top_genres
+    except Exception as e:
+        helper_logger.error(f"Error fetching top genres: {str(e)}")
+        return []
+
+async def fetch_user_preferences_async(asp, recent_limit=20):
+    """Fetch profile, top artists, top genres and recent plays for the preferences page in one round."""
+    async def recent_tracks():
+        try:
+            return (await asp.current_user_recently_played(limit=recent_limit))['items']
+        except Exception as e:
+            helper_logger.error(f"Error fetching recent tracks: {str(e)}")
+            return []
+
+    return await asyncio.gather(
+        get_user_profile_async(asp),
+        get_user_top_artists_async(asp, limit=10),
+        get_user_top_genres_async(asp, limit=10),
+        recent_tracks()
+    )
+
+async def get_tracks_from_favorites_async(asp, favorite_artists, favorite_genres, limit=50):
+    """Async get_tracks_from_favorites for an AsyncSpotify client."""
+    tracks = []
+    try:
+        searches = [asp.search(q=f'artist:{artist}', type='track', limit=10) for artist in favorite_artists]
+        searches += [asp.search(q=f'genre:{genre}', type='track', limit=10) for genre in favorite_genres]
+        for results in await gather_spotify_requests(*searches):
+            if results and 'tracks' in results and 'items' in results['tracks']:
+                tracks.extend(results['tracks']['items'])
+        logger.debug(f"Fetched {len(tracks)} tracks from favorites")
+        return tracks[:limit]
+    except Exception as e:
+        logger.error(f"Error in get_tracks_from_favorites_async: {str(e)}", exc_info=True)
+        return []
+
+async def get_user_top_and_recent_tracks_async(asp, limit=50):
+    """Async get_user_top_and_recent_tracks for an AsyncSpotify client."""
+    try:
+        top_tracks, recent_tracks = await gather_spotify_requests(
+            asp.current_user_top_tracks(limit=limit),
+            asp.current_user_recently_played(limit=limit)
+        )
+        tracks = (top_tracks or {}).get('items', []) + [item['track'] for item in (recent_tracks or {}).get('items', [])]
+        logger.debug(f"Fetched {len(tracks)} top and recent tracks")
+        return tracks[:limit]
+    except Exception as e:
+        logger.error(f"Error in get_user_top_and_recent_tracks_async: {str(e)}", exc_info=True)
+        return []
+
+async def get_new_releases_async(asp, limit=50):
+    """Async get_new_releases for an AsyncSpotify client."""
+    try:
+        new_releases = (await asp.new_releases(limit=limit))['albums']['items']
+        album_ids = [album['id'] for album in new_releases]
+        album_batches = await gather_spotify_requests(*[
+            asp.albums(album_ids[i:i+ALBUM_BATCH_SIZE]) for i in range(0, len(album_ids), ALBUM_BATCH_SIZE)
+        ])
+        tracks = []
+        for batch in album_batches:
+            if batch is None:
+                continue
+            for album in batch['albums']:
+                if album:
+                    tracks.extend(album['tracks']['items'][:2])
+        logger.debug(f"Fetched {len(tracks)} tracks from new releases")
+        return tracks[:limit]
+    except Exception as e:
+        logger.error(f"Error in get_new_releases_async: {str(e)}", exc_info=True)
+        return []
+
+async def get_new_artist_tracks_async(asp, limit=50):
+    """Async get_new_artist_tracks for an AsyncSpotify client."""
+    try:
+        search_results = await asp.search(q='year:2023', type='artist', limit=10)
+        tracks = []
+        top_tracks = await gather_spotify_requests(*[
+            asp.artist_top_tracks(artist['id']) for artist in search_results['artists']['items']
+        ])
+        for artist_top_tracks in top_tracks:
+            if artist_top_tracks is not None:
+                tracks.extend(artist_top_tracks['tracks'][:2])
+        logger.debug(f"Fetched {len(tracks)} tracks from new artists")
+        return tracks[:limit]
+    except Exception as e:
+        logger.error(f"Error in get_new_artist_tracks_async: {str(e)}", exc_info=True)
+        return []
+
+async def fetch_track_pool_sources_async(asp, favorite_artists, favorite_genres):
+    """Fetch the user-specific track pool sources at once; returns (favorites, top_and_recent)."""
+    return await asyncio.gather(
+        get_tracks_from_favorites_async(asp, favorite_artists, favorite_genres),
+        get_user_top_and_recent_tracks_async(asp)
+    )
+
+def get_audio_features(sp, track_ids):
+    """Return {track_id: audio features}, reading the persistent store and fetching only unseen ids.
+
+    Fetched features are matched back to tracks by their id, so a failed batch only loses
+    its own tracks. Tracks Spotify has no features for are remembered for a while and
+    left out of the result.
+    """
+    track_ids = list(dict.fromkeys(track_id for track_id in track_ids if track_id))
+    features_by_id = audio_features_store.get_many(track_ids)
+    unstored = [track_id for track_id in track_ids if track_id not in features_by_id]
+    known_missing = audio_features_store.get_missing(unstored) if unstored else set()
+    missing = [track_id for track_id in unstored if track_id not in known_missing]
+    logger.debug(f"Audio features: {len(features_by_id)} stored, {len(known_missing)} known missing, {len(missing)} to fetch")
+
+    batches = [missing[i:i+AUDIO_FEATURES_BATCH_SIZE] for i in range(0, len(missing), AUDIO_FEATURES_BATCH_SIZE)]
+    futures = [request_executor.submit(make_spotify_request_with_retry, sp, 'audio_features', batch) for batch in batches]
+    fetched = {}
+    without_features = []
+    for batch_number, (batch, future) in enumerate(zip(batches, futures), start=1):
+        try:
+            results = future.result() or []
+            for track_id, features in zip(batch, results):
+                if features:
+                    fetched[features.get('id', track_id)] = features
+                else:
+                    without_features.append(track_id)
+            logger.debug(f"Fetched audio features for batch {batch_number}")
+        except Exception as e:
+            logger.error(f"Error fetching audio features for batch {batch_number}: {str(e)}")
+
+    audio_features_store.put_many(fetched)
+    audio_features_store.put_missing(without_features)
+    features_by_id.update(fetched)
+    return features_by_id
+
+def get_expanded_track_pool(sp, favorite_artists, favorite_genres, user_profile, discovery_ratio=0.3, include_audio_analysis=False, asp=None):
+    """Expand the pool of tracks to include familiar and discovery tracks.
+
+    Scores and audio analysis are computed column-wise for the whole pool and the tracks
+    are returned as TrackRecords; pass include_audio_analysis=True to also fill in each
+    record's audio_analysis.
+    When an AsyncSpotify client is given as asp, the sources are fetched through it.
+    """
     logger.debug(f"Starting get_expanded_track_pool with favorite_artists: {favorite_artists}, favorite_genres: {favorite_genres}")
 
     try:
         favorite_artists = [artist.strip() for artist in favorite_artists.split(',')] if isinstance(favorite_artists, str) else favorite_artists
         favorite_genres = [genre.strip() for genre in favorite_genres.split(',')] if isinstance(favorite_genres, str) else favorite_genres
 
-        familiar_tracks = get_tracks_from_favorites(sp, favorite_artists, favorite_genres)
-        logger.debug(f"Tracks from favorites: {len(familiar_tracks)}")
+        # The sources and the user context are independent, so fetch them all at once and
+        # merge in a fixed order to keep the pool reproducible.
+        user_context_future = source_executor.submit(build_user_context, sp, user_profile.get('id') if user_profile else None)
+        market = (user_profile or {}).get('country') or 'US'
+        candidates_future = source_executor.submit(get_candidate_sources, sp, market)
+        if asp is not None:
+            familiar_tracks, top_and_recent = run_async(fetch_track_pool_sources_async(asp, favorite_artists, favorite_genres))
+        else:
+            favorites_future = source_executor.submit(get_tracks_from_favorites, sp, favorite_artists, favorite_genres)
+            top_and_recent_future = source_executor.submit(get_user_top_and_recent_tracks, sp)
+            familiar_tracks = favorites_future.result()
+            top_and_recent = top_and_recent_future.result()
+        new_releases, new_artist_tracks = candidates_future.result()
 
-        top_and_recent = get_user_top_and_recent_tracks(sp)
+        logger.debug(f"Tracks from favorites: {len(familiar_tracks)}")
         logger.debug(f"Top and recent tracks: {len(top_and_recent)}")
         familiar_tracks += top_and_recent
-
-        new_releases = get_new_releases(sp)
         logger.debug(f"New releases: {len(new_releases)}")
-
-        new_artist_tracks = get_new_artist_tracks(sp)
         logger.debug(f"New artist tracks: {len(new_artist_tracks)}")
 
         all_tracks = familiar_tracks + new_releases + new_artist_tracks
@@ -448,34 +1123,31 @@ def get_expanded_track_pool(sp, favorite_artists, favorite_genres, user_profile,
         all_tracks = list({track['id']: track for track in all_tracks}.values())
         logger.debug(f"Total tracks after deduplication: {len(all_tracks)}")
 
-        track_ids = [track['id'] for track in all_tracks]
-        audio_features = []
+        artist_metadata_future = source_executor.submit(
+            get_artists_metadata, sp, [track['artists'][0].get('id') for track in all_tracks if track.get('artists')])
 
-        batch_size = 100
-        for i in range(0, len(track_ids), batch_size):
-            batch = track_ids[i:i+batch_size]
-            try:
-                batch_features = sp.audio_features(batch)
-                audio_features.extend(batch_features)
-                logger.debug(f"Fetched audio features for batch {i // batch_size + 1}")
-            except Exception as e:
-                logger.error(f"Error fetching audio features for batch {i // batch_size + 1}: {str(e)}")
+        features_by_id = get_audio_features(sp, [track['id'] for track in all_tracks])
+        audio_features = [features_by_id.get(track['id']) for track in all_tracks]
 
-        for track, features in zip(all_tracks, audio_features):
-            if features:
-                try:
-                    logger.debug(f"Calculating discovery score for track: {track.get('name', 'Unknown')} (ID: {track.get('id', 'Unknown')})")
-                    track['discovery_score'] = calculate_discovery_score(track, user_profile, sp)
-                    logger.debug(f"Discovery score calculated: {track['discovery_score']}")
-                    track['audio_analysis'] = analyze_audio_features(features)
-                except Exception as e:
-                    logger.error(f"Error calculating discovery score for track {track.get('id', 'Unknown')}: {str(e)}")
-                    track['discovery_score'] = 0.5  # Assign a neutral score if calculation fails
-            else:
-                logger.warning(f"No audio features found for track {track.get('id', 'Unknown')}")
-                track['discovery_score'] = 0.5  # Assign a neutral score if no features
+        user_context = user_context_future.result()
+        artist_metadata = artist_metadata_future.result()
+        logger.debug(f"Artist metadata available for {len(artist_metadata)} artists")
 
-        sorted_tracks = sorted(all_tracks, key=lambda x: x.get('discovery_score', 0), reverse=True)
+        analysis = analyze_audio_features_batch(audio_features)
+        discovery_scores = calculate_discovery_scores(all_tracks, user_context, artist_metadata)
+        # Tracks without audio features keep a neutral score, as before
+        discovery_scores = np.where(analysis['valid'], discovery_scores, 0.5)
+        logger.debug(f"Scored {len(all_tracks)} tracks, {int((~analysis['valid']).sum())} without audio features")
+
+        records = []
+        for i, track in enumerate(all_tracks):
+            record = track_record_from_spotify(track)
+            record.discovery_score = float(discovery_scores[i])
+            if include_audio_analysis and analysis['valid'][i]:
+                record.audio_analysis = audio_analysis_from_dict(audio_analysis_view(analysis, i))
+            records.append(record)
+
+        sorted_tracks = sorted(records, key=lambda x: x.discovery_score, reverse=True)
         split_index = int(len(sorted_tracks) * discovery_ratio)
         discovery_tracks = sorted_tracks[:split_index]
         familiar_tracks = sorted_tracks[split_index:]
@@ -488,101 +1160,398 @@ def get_expanded_track_pool(sp, favorite_artists, favorite_genres, user_profile,
         logger.error(f"Error in get_expanded_track_pool: {str(e)}", exc_info=True)
         raise
 
-def parse_openai_response(response):
-    """Parse the response from OpenAI to extract recommended tracks and explanations."""
+def split_recommendation_response(response):
+    """Split a completion into its JSON (the ```json block, else everything from the first brace)
+    and the explanation written after the block."""
+    json_match = re.search(r'```(?:json)?\s*(\{[\s\S]*?)\s*```', response)
+    if json_match:
+        return json_match.group(1), response[json_match.end():].strip()
+    start = response.find('{')
+    return (response[start:], "") if start != -1 else ("", "")
+
+def salvage_recommendations(response):
+    """Recover the complete track objects (and the description, if it was written) from truncated JSON."""
+    tracks = []
+    for track in IncrementalTrackParser().feed(response):
+        try:
+            tracks.append(msgspec.convert(track, type=RecommendedTrack, strict=False))
+        except msgspec.ValidationError as e:
+            if not isinstance(track.get('name'), str):
+                logger.warning(f"Skipping malformed track object in OpenAI response: {str(e)}")
+                continue
+            # Keep anything with a usable name, dropping only the fields that do not fit
+            tracks.append(RecommendedTrack(
+                name=track['name'],
+                artist=track.get('artist') if isinstance(track.get('artist'), str) else None,
+                reason=track.get('reason') if isinstance(track.get('reason'), str) else None
+            ))
+    description_match = re.search(r'"playlist_description"\s*:\s*("(?:[^"\\]|\\.)*")', response)
+    playlist_description = json.loads(description_match.group(1)) if description_match else ""
+    return Recommendations(playlist_description=playlist_description, tracks=tracks)
+
+def parse_openai_response(response, stats=None):
+    """Parse the response from OpenAI to extract recommended tracks and explanations.
+
+    The JSON is decoded straight into the Recommendations struct. If it is truncated or
+    otherwise invalid, every complete track object is salvaged instead of discarding the
+    completion; the count is logged and added to stats (a Counter) as 'recovered_tracks'.
+    """
     logger.debug("Starting to parse OpenAI response")
     logger.debug(f"Raw OpenAI response: {response}")
 
-    try:
-        json_match = re.search(r'```json\s*([\s\S]*?)\s*```', response)
-
-        if json_match:
-            json_content = json_match.group(1)
-            logger.debug(f"Extracted JSON content: {json_content}")
-
-            response_json = json.loads(json_content)
-
-            recommended_tracks = response_json.get("tracks", [])
-            playlist_description = response_json.get("playlist_description", "")
-
-            explanation_match = re.search(r'```\s*([\s\S]*)$', response, re.DOTALL)
-            explanation = explanation_match.group(1).strip() if explanation_match else ""
-
-            logger.info(f"Parsed {len(recommended_tracks)} tracks from OpenAI response")
-            logger.debug(f"Playlist description: {playlist_description}")
-            logger.debug(f"Explanation: {explanation[:100]}...")
+    if not response:
+        logger.error("Empty OpenAI response")
+        return [], "", ""
 
-            return recommended_tracks, playlist_description, explanation
-        else:
+    try:
+        json_content, explanation = split_recommendation_response(response)
+        if not json_content:
             logger.error("No JSON content found in the response")
             return [], "", ""
-    except json.JSONDecodeError as e:
-        logger.error(f"Error parsing JSON response: {str(e)}")
-        return [], "", ""
+
+        try:
+            recommendations = msgspec.json.decode(json_content, type=Recommendations)
+        except msgspec.DecodeError as e:
+            recommendations = salvage_recommendations(json_content)
+            logger.warning(f"Invalid or truncated JSON in OpenAI response ({str(e)}); "
+                           f"recovered {len(recommendations.tracks)} complete tracks")
+            if stats is not None:
+                stats['recovered_tracks'] += len(recommendations.tracks)
+
+        recommended_tracks = [
+            track.to_dict() for track in recommendations.tracks
+            if track.name or track.id is not None
+        ]
+        playlist_description = recommendations.playlist_description or ""
+
+        logger.info(f"Parsed {len(recommended_tracks)} tracks from OpenAI response")
+        logger.debug(f"Playlist description: {playlist_description}")
+        logger.debug(f"Explanation: {explanation[:100]}...")
+
+        return recommended_tracks, playlist_description, explanation
     except Exception as e:
         logger.error(f"Unexpected error parsing response: {str(e)}")
         return [], "", ""
 
-def find_tracks_on_spotify(sp, recommended_tracks):
-    """Find the recommended tracks on Spotify."""
-    selected_tracks = []
-    log_file = 'logs/search_queries.txt'
-
-    with open(log_file, 'w', encoding='utf-8') as f:
-        f.write("Spotify Search Queries:\n\n")
+class IncrementalTrackParser:
+    """Pull complete track objects out of the recommendation JSON while it is still being written.
+
+    feed() takes the next piece of the completion and returns the objects of the "tracks"
+    array that it completed. A small scanner tracks strings and nesting, so braces inside
+    names or reasons are handled and text around the JSON (such as a code fence) is ignored.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.tracks = []
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        # Depth of the "tracks" array while inside it, and where the current track object began
+        self._tracks_depth = None
+        self._tracks_done = False
+        self._object_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        completed = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = text[self._string_start + 1:i]
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char in '{[':
+                self._depth += 1
+                if char == '[' and self._tracks_depth is None and not self._tracks_done and self._last_string == 'tracks':
+                    self._tracks_depth = self._depth
+                elif char == '{' and self._tracks_depth is not None and self._depth == self._tracks_depth + 1:
+                    self._object_start = i
+            elif char in '}]':
+                if char == '}' and self._object_start is not None and self._depth == self._tracks_depth + 1:
+                    try:
+                        track = json.loads(text[self._object_start:i + 1])
+                        if isinstance(track, dict) and (track.get('name') or track.get('id') is not None):
+                            completed.append(track)
+                    except json.JSONDecodeError as e:
+                        logger.warning(f"Skipping unparseable track object in streamed response: {str(e)}")
+                    self._object_start = None
+                elif char == ']' and self._tracks_depth is not None and self._depth == self._tracks_depth:
+                    self._tracks_depth = None
+                    self._tracks_done = True
+                self._depth = max(self._depth - 1, 0)
+        self._pos = len(text)
+        self.tracks.extend(completed)
+        return completed
+
+class TrackResolution:
+    """Outcome of resolving one recommendation: the id found, how it was found and the search log."""
+
+    def __init__(self, track_id=None, source='not_found', searches=0, log_lines=None):
+        self.track_id = track_id
+        self.source = source
+        self.searches = searches
+        self.log_lines = log_lines or []
+
+def track_resolution(track, pool_index=None, cached=None):
+    """Resolve one recommended track to a Spotify id: the pool index, a cached resolution
+    (cached is a (track_id, match) pair from track_resolution_store), an exact search, then
+    a relaxed one.
+
+    The steps are written once as a generator and shared by the sync and async resolvers:
+    it yields search queries, is sent each search result (or thrown the search's error) and
+    returns a TrackResolution. Spotify errors other than rate limiting are re-raised.
+    """
+    track_name = track.get('name')
+    artist_name = track.get('artist')
+    resolution = TrackResolution(log_lines=[f"Searching - Track: '{track_name}', Artist: '{artist_name}'\n"])
+    log_lines = resolution.log_lines
+
+    if track.get('spotify_id'):
+        # A pool pick referenced by number in the 'ids' prompt mode
+        resolution.track_id = track['spotify_id']
+        resolution.source = 'prompt_id'
+        log_lines.append(f"FOUND (Pool pick) - Track: '{track_name}', Artist: '{artist_name}', ID: {track['spotify_id']}\n\n")
+        return resolution
+
+    if pool_index is not None:
+        pooled, fuzzy = pool_index.lookup(track_name, artist_name)
+        if pooled is not None:
+            resolution.track_id = pooled.id
+            resolution.source = 'pool_fuzzy' if fuzzy else 'pool'
+            log_lines.append(f"FOUND ({'Pool, fuzzy' if fuzzy else 'Pool'}) - Track: '{pooled.name}', Artist: '{pooled.artist}', ID: {pooled.id}\n\n")
+            return resolution
+
+    if cached is not None:
+        track_id, match = cached
+        if track_id:
+            resolution.track_id = track_id
+            resolution.source = 'cache'
+            log_lines.append(f"FOUND (Cached, {match}) - Track: '{track_name}', Artist: '{artist_name}', ID: {track_id}\n\n")
+        else:
+            resolution.source = 'cache_not_found'
+            log_lines.append(f"NOT FOUND (Cached) - Track: '{track_name}', Artist: '{artist_name}'\n\n")
+        return resolution
 
-    for track in recommended_tracks:
-        try:
-            track_name = track['name']
-            artist_name = track['artist']
-
-            exact_query = f"track:{track_name} artist:{artist_name}"
-            with open(log_file, 'a', encoding='utf-8') as f:
-                f.write(f"Searching - Track: '{track_name}', Artist: '{artist_name}'\n")
-
-            result = make_spotify_request_with_retry(sp, 'search', q=exact_query, type='track', limit=1)
-            if result['tracks']['items']:
-                found_track = result['tracks']['items'][0]
-                selected_tracks.append(found_track['id'])
-                logger.debug(f"Found track: {found_track['name']} by {found_track['artists'][0]['name']}")
-                with open(log_file, 'a', encoding='utf-8') as f:
-                    f.write(f"FOUND - Track: '{found_track['name']}', Artist: '{found_track['artists'][0]['name']}', ID: {found_track['id']}\n\n")
+    try:
+        resolution.searches += 1
+        result = yield f"track:{track_name} artist:{artist_name}"
+        resolution.source = 'exact'
+        label = "FOUND"
+        if not result['tracks']['items']:
+            relaxed_query = f"{track_name} {artist_name}"
+            log_lines.append(f"Relaxed search: {relaxed_query}\n")
+            resolution.searches += 1
+            result = yield relaxed_query
+            resolution.source = 'relaxed'
+            label = "FOUND (Relaxed)"
+        if result['tracks']['items']:
+            found_track = result['tracks']['items'][0]
+            logger.debug(f"Found track: {found_track['name']} by {found_track['artists'][0]['name']}")
+            log_lines.append(f"{label} - Track: '{found_track['name']}', Artist: '{found_track['artists'][0]['name']}', ID: {found_track['id']}\n\n")
+            resolution.track_id = found_track['id']
+            return resolution
+        logger.warning(f"Could not find track: {track_name} by {artist_name}")
+        log_lines.append(f"NOT FOUND - Track: '{track_name}', Artist: '{artist_name}'\n\n")
+        resolution.source = 'not_found'
+    except SpotifyException as e:
+        logger.error(f"Spotify API error searching for track {track_name} by {artist_name}: {str(e)}")
+        log_lines.append(f"ERROR - Track: '{track_name}', Artist: '{artist_name}', Error: {str(e)}\n\n")
+        if e.http_status != 429:
+            raise
+        spotify_limiter.pause(retry_after_seconds(e.headers or {}, default=30))
+        resolution.source = 'error'
+    except Exception as e:
+        logger.error(f"Unexpected error searching for track {track_name} by {artist_name}: {str(e)}")
+        log_lines.append(f"UNEXPECTED ERROR - Track: '{track_name}', Artist: '{artist_name}', Error: {str(e)}\n\n")
+        resolution.source = 'error'
+    return resolution
+
+def resolve_track(sp, track, pool_index=None, cached=None):
+    """Run track_resolution for one track with the synchronous client."""
+    steps = track_resolution(track, pool_index, cached)
+    try:
+        query = next(steps)
+        while True:
+            try:
+                result = make_spotify_request_with_retry(sp, 'search', q=query, type='track', limit=1)
+            except Exception as e:
+                query = steps.throw(e)
             else:
-                relaxed_query = f"{track_name} {artist_name}"
-                with open(log_file, 'a', encoding='utf-8') as f:
-                    f.write(f"Relaxed search: {relaxed_query}\n")
-
-                result = make_spotify_request_with_retry(sp, 'search', q=relaxed_query, type='track', limit=1)
-                if result['tracks']['items']:
-                    found_track = result['tracks']['items'][0]
-                    selected_tracks.append(found_track['id'])
-                    logger.debug(f"Found similar track: {found_track['name']} by {found_track['artists'][0]['name']}")
-                    with open(log_file, 'a', encoding='utf-8') as f:
-                        f.write(f"FOUND (Relaxed) - Track: '{found_track['name']}', Artist: '{found_track['artists'][0]['name']}', ID: {found_track['id']}\n\n")
-                else:
-                    logger.warning(f"Could not find track: {track_name} by {artist_name}")
-                    with open(log_file, 'a', encoding='utf-8') as f:
-                        f.write(f"NOT FOUND - Track: '{track_name}', Artist: '{artist_name}'\n\n")
-        except SpotifyException as e:
-            logger.error(f"Spotify API error searching for track {track_name} by {artist_name}: {str(e)}")
-            with open(log_file, 'a', encoding='utf-8') as f:
-                f.write(f"ERROR - Track: '{track_name}', Artist: '{artist_name}', Error: {str(e)}\n\n")
-            if e.http_status == 429:
-                retry_after = int(e.headers.get('Retry-After', 30))
-                logger.info(f"Rate limited. Waiting for {retry_after} seconds before retrying.")
-                time.sleep(retry_after)
+                query = steps.send(result)
+    except StopIteration as done:
+        return done.value
+
+async def resolve_track_async(asp, track, pool_index=None, cached=None):
+    """Run track_resolution for one track with the AsyncSpotify client."""
+    steps = track_resolution(track, pool_index, cached)
+    try:
+        query = next(steps)
+        while True:
+            try:
+                result = await asp.search(q=query, type='track', limit=1)
+            except Exception as e:
+                query = steps.throw(e)
             else:
-                raise
-        except Exception as e:
-            logger.error(f"Unexpected error searching for track {track_name} by {artist_name}: {str(e)}")
-            with open(log_file, 'a', encoding='utf-8') as f:
-                f.write(f"UNEXPECTED ERROR - Track: '{track_name}', Artist: '{artist_name}', Error: {str(e)}\n\n")
+                query = steps.send(result)
+    except StopIteration as done:
+        return done.value
 
-    logger.info(f"Total tracks found: {len(selected_tracks)}")
+def write_search_log(resolutions, stats=None, log_file='logs/search_queries.txt'):
+    """Write the search log of resolved tracks in recommendation order and return the found ids.
+
+    If a stats Counter is given, it is updated with how each track was resolved, the
+    searches made and the searches the pool index avoided.
+    """
+    with open(log_file, 'w', encoding='utf-8') as f:
+        f.write("Spotify Search Queries:\n\n")
+        for resolution in resolutions:
+            f.writelines(resolution.log_lines)
+
+    counts = Counter(resolution.source for resolution in resolutions)
+    counts['searches'] = sum(resolution.searches for resolution in resolutions)
+    counts['searches_avoided'] = (counts['prompt_id'] + counts['pool'] + counts['pool_fuzzy'] +
+                                  counts['cache'] + counts['cache_not_found'])
+    if stats is not None:
+        stats.update(counts)
+
+    selected_tracks = [resolution.track_id for resolution in resolutions if resolution.track_id]
+    logger.info(f"Total tracks found: {len(selected_tracks)} "
+                f"({counts['searches']} searches, {counts['searches_avoided']} avoided via the track pool and cache)")
     return selected_tracks
 
+def load_cached_resolutions(keys):
+    """Return the live track_resolution_store entries for keys; a store failure just means searching."""
+    try:
+        return track_resolution_store.get_many(keys)
+    except Exception as e:
+        logger.error(f"Error reading cached track resolutions: {str(e)}")
+        return {}
+
+def remember_resolutions(keys, resolutions):
+    """Store the outcome of every search-based resolution, including misses, for other users."""
+    searched = {
+        key: (resolution.track_id, resolution.source)
+        for key, resolution in zip(keys, resolutions)
+        if resolution.source in ('exact', 'relaxed', 'not_found')
+    }
+    try:
+        track_resolution_store.put_many(searched)
+    except Exception as e:
+        logger.error(f"Error caching track resolutions: {str(e)}")
+
+def find_tracks_on_spotify(sp, recommended_tracks, pool_tracks=None, stats=None):
+    """Find the recommended tracks on Spotify.
+
+    Recommendations that match a track in pool_tracks, or that any user has resolved
+    recently, are answered without a search; the rest are searched in parallel on
+    request_executor, so the total time is close to the slowest lookup. Ids come back in
+    recommendation order.
+    """
+    pool_index = TrackPoolIndex(pool_tracks) if pool_tracks else None
+    keys = [resolution_key(track.get('name'), track.get('artist')) for track in recommended_tracks]
+    cached = load_cached_resolutions(keys)
+    futures = [
+        request_executor.submit(resolve_track, sp, track, pool_index, cached.get(key))
+        for track, key in zip(recommended_tracks, keys)
+    ]
+    resolutions = [future.result() for future in futures]
+    remember_resolutions(keys, resolutions)
+    return write_search_log(resolutions, stats)
+
+async def find_tracks_on_spotify_async(asp, recommended_tracks, pool_tracks=None, stats=None, max_concurrency=8):
+    """Async find_tracks_on_spotify: resolves all recommendations concurrently, keeping their order."""
+    pool_index = TrackPoolIndex(pool_tracks) if pool_tracks else None
+    keys = [resolution_key(track.get('name'), track.get('artist')) for track in recommended_tracks]
+    # Keep SQLite off the event loop
+    cached = await asyncio.to_thread(load_cached_resolutions, keys)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def resolve(track, key):
+        async with semaphore:
+            return await resolve_track_async(asp, track, pool_index, cached.get(key))
+
+    resolutions = await asyncio.gather(*[resolve(track, key) for track, key in zip(recommended_tracks, keys)])
+    await asyncio.to_thread(remember_resolutions, keys, resolutions)
+    return write_search_log(resolutions, stats)
+
+def stream_and_resolve_tracks(sp, chunks, pool_tracks=None, asp=None, prompt_tracks=None):
+    """Parse a streamed recommendation completion and resolve each track on Spotify as soon as it is complete.
+
+    Yields progress events as dicts: 'track' when a track object is parsed, 'resolved' when
+    its lookup finishes (in completion order), then a final 'done' event carrying the full
+    response text, the parsed tracks, the ordered track ids and the resolution counts.
+    Lookups run on request_executor, or on the async client when asp is given. prompt_tracks
+    are the tracks the prompt listed, when it was built from a subset of the pool.
+    """
+    pool_index = TrackPoolIndex(pool_tracks) if pool_tracks else None
+    numbers = prompt_track_numbers((pool_tracks or []) if prompt_tracks is None else prompt_tracks)
+    parser = IncrementalTrackParser()
+    tracks = []
+    keys = []
+    futures = {}
+    resolutions = []
+
+    def submit(index, track):
+        key = resolution_key(track.get('name'), track.get('artist'))
+        keys.append(key)
+        cached = load_cached_resolutions([key]).get(key)
+        if asp is not None:
+            future = submit_async(resolve_track_async(asp, track, pool_index, cached))
+        else:
+            future = request_executor.submit(resolve_track, sp, track, pool_index, cached)
+        futures[future] = index
+
+    def finished(timeout=0):
+        done, _ = wait(list(futures), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = futures.pop(future)
+            resolution = future.result()
+            resolutions[index] = resolution
+            yield {'event': 'resolved', 'index': index, 'track_id': resolution.track_id, 'source': resolution.source}
+
+    for chunk in chunks:
+        for track in parser.feed(chunk):
+            track = expand_prompt_track(track, numbers)
+            if track is None:
+                continue
+            tracks.append(track)
+            index = len(resolutions)
+            resolutions.append(None)
+            submit(index, track)
+            yield {'event': 'track', 'index': index, 'name': track.get('name'), 'artist': track.get('artist')}
+        if futures:
+            yield from finished()
+
+    while futures:
+        yield from finished(timeout=None)
+
+    remember_resolutions(keys, resolutions)
+    stats = Counter()
+    spotify_track_ids = write_search_log(resolutions, stats)
+    yield {
+        'event': 'done',
+        'response': parser.text,
+        'tracks': tracks,
+        'spotify_track_ids': spotify_track_ids,
+        'resolution_stats': dict(stats)
+    }
+
 def get_wayback_tracks(sp, limit=5, max_recent_tracks=200, max_saved_tracks=500):
-    """Retrieve tracks from the user's library that haven't been played recently."""
+    """Retrieve tracks from the user's library that haven't been played recently, as TrackRecords."""
     helper_logger.debug(f"Fetching 'Way Back' tracks. Limit: {limit}, Max recent: {max_recent_tracks}, Max saved: {max_saved_tracks}")
 
     recent_tracks = []
@@ -621,20 +1590,112 @@ def get_wayback_tracks(sp, limit=5, max_recent_tracks=200, max_saved_tracks=500)
     wayback_tracks = old_tracks + recent_tracks
     random.shuffle(wayback_tracks)
 
-    for track in wayback_tracks:
-        track['added_at_formatted'] = datetime.strptime(track['added_at'], "%Y-%m-%dT%H:%M:%SZ").strftime("%B %d, %Y")
-
-    final_tracks = wayback_tracks[:limit]
+    final_tracks = [track_record_from_spotify(item['track'], added_at=item['added_at']) for item in wayback_tracks[:limit]]
     helper_logger.debug(f"Returning {len(final_tracks)} 'Way Back' tracks")
 
     return final_tracks
 
-def calculate_discovery_score(track, user_profile, sp):
-    """Calculate a discovery score for a track based on the user's listening history and preferences."""
+class UserContext:
+    """User-level data needed by calculate_discovery_score, fetched once per track pool build."""
+
+    def __init__(self, top_genres=None, recent_track_ids=None, playlist_index=None):
+        self.top_genres = set(top_genres or [])
+        self.recent_track_ids = set(recent_track_ids or [])
+        self.playlist_index = playlist_index or {}
+        self.playlist_track_ids = self.playlist_index.keys()
+
+    def __repr__(self):
+        return (f"UserContext(top_genres={len(self.top_genres)}, recent_track_ids={len(self.recent_track_ids)}, "
+                f"playlist_track_ids={len(self.playlist_track_ids)})")
+
+def fetch_all_playlist_track_ids(sp, playlist_id):
+    """Page through a playlist and return the ids of all its tracks."""
+    track_ids = []
+    offset = 0
+    while True:
+        page = make_spotify_request_with_retry(
+            sp, 'playlist_items', playlist_id, fields='items(track(id)),next', limit=100, offset=offset,
+            additional_types=('track',))
+        track_ids.extend(item['track']['id'] for item in page['items'] if item.get('track') and item['track'].get('id'))
+        if not page.get('next'):
+            return track_ids
+        offset += 100
+
+def sync_playlist_index(sp, user_id):
+    """Bring the user's playlist membership index up to date and return {track_id: set(playlist_ids)}.
+
+    Every playlist is listed once; only playlists whose snapshot_id changed since the last
+    sync have their tracks fetched again.
+    """
+    known_snapshots = playlist_index_store.get_snapshots(user_id)
+    current_snapshots = {}
+    offset = 0
+    while True:
+        page = make_spotify_request_with_retry(sp, 'current_user_playlists', limit=50, offset=offset)
+        for playlist in page['items']:
+            current_snapshots[playlist['id']] = playlist.get('snapshot_id')
+        if not page.get('next'):
+            break
+        offset += 50
+
+    stale = [playlist_id for playlist_id, snapshot_id in current_snapshots.items()
+             if known_snapshots.get(playlist_id) != snapshot_id or snapshot_id is None]
+    futures = [(playlist_id, request_executor.submit(fetch_all_playlist_track_ids, sp, playlist_id)) for playlist_id in stale]
+    for playlist_id, future in futures:
+        try:
+            playlist_index_store.replace_playlist(user_id, playlist_id, current_snapshots[playlist_id], future.result())
+        except Exception as e:
+            logger.warning(f"Error indexing playlist {playlist_id}: {str(e)}")
+
+    removed = set(known_snapshots) - set(current_snapshots)
+    if removed:
+        playlist_index_store.remove_playlists(user_id, removed)
+
+    logger.debug(f"Playlist index synced: {len(current_snapshots)} playlists, {len(stale)} refreshed, {len(removed)} removed")
+    return playlist_index_store.load_index(user_id)
+
+def build_user_context(sp, user_id=None):
+    """Fetch the user's top genres, recent plays and playlist index once for scoring a whole pool."""
+    logger.debug("Building user context for discovery scoring")
+    top_genres = []
+    recent_track_ids = []
+    playlist_index = {}
+
+    try:
+        top_genres = [genre['name'] for genre in get_user_top_genres(sp, limit=50)]
+    except Exception as e:
+        logger.warning(f"Error fetching top genres for user context: {str(e)}")
+
+    try:
+        recent_tracks = make_spotify_request_with_retry(sp, 'current_user_recently_played', limit=50)
+        recent_track_ids = [item['track']['id'] for item in recent_tracks['items'] if item.get('track')]
+    except Exception as e:
+        logger.warning(f"Error fetching recently played tracks: {str(e)}")
+
+    try:
+        if user_id is None:
+            user_id = make_spotify_request_with_retry(sp, 'me')['id']
+        playlist_index = sync_playlist_index(sp, user_id)
+    except Exception as e:
+        logger.warning(f"Error checking user playlists: {str(e)}")
+
+    user_context = UserContext(top_genres, recent_track_ids, playlist_index)
+    logger.debug(f"Built {user_context}")
+    return user_context
+
+def calculate_discovery_score(track, user_profile, sp, user_context=None):
+    """Calculate a discovery score for a track based on the user's listening history and preferences.
+
+    Pass a UserContext from build_user_context when scoring many tracks; without one the
+    user's data is fetched for this track alone.
+    """
     logger.debug(f"Calculating discovery score for track: {track.get('id', 'Unknown ID')}")
     logger.debug(f"Track data: {track}")
     logger.debug(f"User profile: {user_profile}")
 
+    if user_context is None:
+        user_context = build_user_context(sp)
+
     score = 0.5
 
     try:
@@ -643,53 +1704,34 @@ def calculate_discovery_score(track, user_profile, sp):
             score += (100 - popularity) / 200
             logger.debug(f"Adjusted score based on popularity: {score}")
 
+        artist_info = None
         if track.get('artists') and len(track['artists']) > 0:
             artist_id = track['artists'][0].get('id')
             if artist_id:
                 try:
-                    artist_info = sp.artist(artist_id)
-                    artist_popularity = artist_info.get('popularity')
-                    if artist_popularity is not None:
-                        score += (100 - artist_popularity) / 200
-                        logger.debug(f"Adjusted score based on artist popularity: {score}")
+                    artist_info = get_artist_metadata(sp, artist_id)
                 except Exception as e:
                     logger.warning(f"Error fetching artist info: {str(e)}")
 
-        try:
-            user_top_genres = get_user_top_genres(sp, limit=50)
-            if track.get('artists') and track['artists']:
-                artist_id = track['artists'][0].get('id')
-                if artist_id:
-                    artist_info = sp.artist(artist_id)
-                    artist_genres = set(artist_info.get('genres', []))
-                    genre_overlap = len(set(genre['name'] for genre in user_top_genres) & artist_genres)
-                    score_adjustment = genre_overlap * 0.1
-                    score -= score_adjustment
-                    logger.debug(f"Adjusted score based on genre overlap: -{score_adjustment}")
-        except Exception as e:
-            logger.warning(f"Error in genre preference calculation: {str(e)}")
+        if artist_info:
+            artist_popularity = artist_info.get('popularity')
+            if artist_popularity is not None:
+                score += (100 - artist_popularity) / 200
+                logger.debug(f"Adjusted score based on artist popularity: {score}")
 
-        try:
-            recent_tracks = sp.current_user_recently_played(limit=50)
-            recent_track_ids = [item['track']['id'] for item in recent_tracks['items'] if item.get('track')]
-            if track.get('id') in recent_track_ids:
-                score -= 0.3
-                logger.debug("Reduced score by 0.3 due to recent play")
-        except Exception as e:
-            logger.warning(f"Error fetching recently played tracks: {str(e)}")
+            artist_genres = set(artist_info.get('genres', []))
+            genre_overlap = len(user_context.top_genres & artist_genres)
+            score_adjustment = genre_overlap * 0.1
+            score -= score_adjustment
+            logger.debug(f"Adjusted score based on genre overlap: -{score_adjustment}")
 
-        try:
-            user_playlists = sp.current_user_playlists(limit=50)
-            for playlist in user_playlists['items']:
-                if playlist.get('tracks', {}).get('total', 0) > 0:
-                    playlist_tracks = sp.playlist_tracks(playlist['id'])
-                    playlist_track_ids = [item['track']['id'] for item in playlist_tracks['items'] if item.get('track')]
-                    if track.get('id') in playlist_track_ids:
-                        score -= 0.2
-                        logger.debug("Reduced score by 0.2 due to presence in user playlist")
-                        break
-        except Exception as e:
-            logger.warning(f"Error checking user playlists: {str(e)}")
+        if track.get('id') in user_context.recent_track_ids:
+            score -= 0.3
+            logger.debug("Reduced score by 0.3 due to recent play")
+
+        if track.get('id') in user_context.playlist_track_ids:
+            score -= 0.2
+            logger.debug("Reduced score by 0.2 due to presence in user playlist")
 
     except Exception as e:
         logger.error(f"Error calculating discovery score: {str(e)}", exc_info=True)
@@ -769,3 +1811,125 @@ def analyze_audio_features(audio_features):
         'time_signature': audio_features['time_signature']
     }
 
+AUDIO_FEATURE_COLUMNS = (
+    'valence', 'energy', 'acousticness', 'loudness', 'tempo', 'danceability',
+    'instrumentalness', 'key', 'mode', 'time_signature'
+)
+
+def build_audio_feature_columns(audio_features):
+    """Load a list of audio feature dicts (None for missing) into one NumPy array per feature."""
+    count = len(audio_features)
+    columns = {name: np.zeros(count) for name in AUDIO_FEATURE_COLUMNS}
+    valid = np.zeros(count, dtype=bool)
+    for i, features in enumerate(audio_features):
+        if not features:
+            continue
+        try:
+            values = [features[name] for name in AUDIO_FEATURE_COLUMNS]
+        except KeyError:
+            continue
+        for name, value in zip(AUDIO_FEATURE_COLUMNS, values):
+            columns[name][i] = value
+        valid[i] = True
+    columns['valid'] = valid
+    return columns
+
+def analyze_audio_features_batch(audio_features):
+    """Vectorized analyze_audio_features over a whole pool; returns a dict of arrays aligned with the input."""
+    f = build_audio_feature_columns(audio_features)
+    valence, energy, acousticness = f['valence'], f['energy'], f['acousticness']
+    loudness, tempo = f['loudness'], f['tempo']
+
+    tempo_category = np.select(
+        [tempo < 60, tempo < 90, tempo < 120, tempo < 150],
+        ["Very Slow", "Slow", "Moderate", "Fast"],
+        default="Very Fast"
+    )
+    best_time_of_day = np.select(
+        [(energy > 0.7) & (valence > 0.7), (energy > 0.5) & (valence > 0.5), (energy < 0.4) & (valence < 0.4)],
+        ["Morning", "Afternoon", "Night"],
+        default="Evening"
+    )
+
+    return {
+        'valid': f['valid'],
+        'happiness': (valence * 0.6 + energy * 0.4) * 100,
+        'energy': energy * 100,
+        'relaxation': ((1 - energy) * 0.5 + acousticness * 0.3 + (1 - loudness / -60) * 0.2) * 100,
+        'intensity': (energy * 0.4 + loudness / -60 * 0.3 + tempo / 200 * 0.3) * 100,
+        'activities': {
+            "Dancing": f['danceability'] > 0.7,
+            "Working Out": energy > 0.8,
+            "Relaxing": acousticness > 0.7,
+            "Studying": f['instrumentalness'] > 0.5,
+            "Partying": valence > 0.7
+        },
+        'best_time_of_day': best_time_of_day,
+        'danceability': f['danceability'] * 100,
+        'acousticness': acousticness * 100,
+        'instrumentalness': f['instrumentalness'] * 100,
+        'tempo_category': tempo_category,
+        'tempo': tempo,
+        'key': f['key'],
+        'mode': f['mode'],
+        'time_signature': f['time_signature']
+    }
+
+def audio_analysis_view(analysis, i):
+    """Build the per-track dict returned by analyze_audio_features from batch analysis row i."""
+    activities = [name for name, mask in analysis['activities'].items() if mask[i]] or ["General Listening"]
+    return {
+        'mood_scores': {
+            'happiness': float(analysis['happiness'][i]),
+            'energy': float(analysis['energy'][i]),
+            'relaxation': float(analysis['relaxation'][i]),
+            'intensity': float(analysis['intensity'][i])
+        },
+        'suitable_activities': activities,
+        'best_time_of_day': str(analysis['best_time_of_day'][i]),
+        'danceability': float(analysis['danceability'][i]),
+        'acousticness': float(analysis['acousticness'][i]),
+        'instrumentalness': float(analysis['instrumentalness'][i]),
+        'tempo_category': str(analysis['tempo_category'][i]),
+        'tempo': float(analysis['tempo'][i]),
+        'key': int(analysis['key'][i]),
+        'mode': int(analysis['mode'][i]),
+        'time_signature': int(analysis['time_signature'][i])
+    }
+
+def calculate_discovery_scores(tracks, user_context, artist_metadata):
+    """Vectorized calculate_discovery_score for a list of tracks; returns an array of scores in [0, 1]."""
+    count = len(tracks)
+    popularity = np.full(count, np.nan)
+    artist_popularity = np.full(count, np.nan)
+    genre_overlap = np.zeros(count)
+    recently_played = np.zeros(count, dtype=bool)
+    in_playlist = np.zeros(count, dtype=bool)
+
+    overlap_by_artist = {
+        artist_id: len(user_context.top_genres & set(info.get('genres', [])))
+        for artist_id, info in artist_metadata.items()
+    }
+
+    for i, track in enumerate(tracks):
+        if track.get('popularity') is not None:
+            popularity[i] = track['popularity']
+        artist_id = track['artists'][0].get('id') if track.get('artists') else None
+        info = artist_metadata.get(artist_id)
+        if info:
+            if info.get('popularity') is not None:
+                artist_popularity[i] = info['popularity']
+            genre_overlap[i] = overlap_by_artist[artist_id]
+        track_id = track.get('id')
+        recently_played[i] = track_id in user_context.recent_track_ids
+        in_playlist[i] = track_id in user_context.playlist_track_ids
+
+    scores = (
+        0.5
+        + np.nan_to_num((100 - popularity) / 200)
+        + np.nan_to_num((100 - artist_popularity) / 200)
+        - genre_overlap * 0.1
+        - recently_played * 0.3
+        - in_playlist * 0.2
+    )
+    return np.clip(scores, 0, 1)
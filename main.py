@@ -1,6 +1,6 @@
-from flask import Flask, request, jsonify, session, redirect, render_template, url_for, flash
+from flask import Flask, request, jsonify, session, redirect, render_template, url_for, flash, Response, stream_with_context
 from flask_session import Session
-from spotipy.oauth2 import SpotifyOAuth
+from spotipy.oauth2 import SpotifyOAuth, SpotifyClientCredentials
 from dotenv import load_dotenv
 import os
 import spotipy
@@ -10,24 +10,49 @@ from openai import OpenAI
 from datetime import datetime 
 import json
 import time
+import uuid
+from typing import List
+from collections import Counter
+
+# Load environment variables before the local modules read their settings at import time
+load_dotenv()
 
 from helpers import (
     PlaylistForm, get_user_profile, get_user_top_artists, get_user_top_genres,
     get_expanded_track_pool, parse_openai_response, find_tracks_on_spotify,
     make_spotify_request_with_retry, logger, get_openai_recommendations, 
-    get_wayback_tracks, get_playlist_picks
+    get_wayback_tracks, get_playlist_picks, fetch_user_preferences_async, find_tracks_on_spotify_async,
+    start_candidate_refresher, cache, spotify_single_flight, stream_openai_recommendations, stream_and_resolve_tracks,
+    expand_prompt_tracks
 )
-
-# Load environment variables and configure app
-load_dotenv()
-
+from spotify_async import AsyncSpotify, run_async
+from ranking import get_local_recommendations, prefilter_prompt_tracks
+from caching import connect_redis
+from records import TrackRecord, track_record_from_spotify
+from stores import build_pool_store
+from ratelimit import spotify_limiter, spotify_concurrency, spotify_requests_session
+
+# Configure app
 app = Flask(__name__)
 app.config['DEBUG'] = True
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_FILE_DIR'] = './.flask_session/'
+# Sessions live in Redis when it is configured so any worker or host can serve a user
+session_redis = connect_redis()
+if session_redis is not None:
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = session_redis
+else:
+    app.config['SESSION_TYPE'] = 'filesystem'
+    app.config['SESSION_FILE_DIR'] = './.flask_session/'
+# Use the pooled async Spotify client for fan-out heavy routes
+app.config['SPOTIFY_ASYNC'] = os.getenv('SPOTIFY_ASYNC', '').lower() in ('1', 'true', 'yes')
+# Stream the model's answer and resolve each track on Spotify as it arrives
+app.config['OPENAI_STREAMING'] = os.getenv('OPENAI_STREAMING', '').lower() in ('1', 'true', 'yes')
 Session(app)
 
+# Track pools, playlist results and preference lists, referenced from the session by pool_id
+pool_store = build_pool_store(session_redis)
+
 sp_oauth = SpotifyOAuth(
     client_id=os.getenv('SPOTIFY_CLIENT_ID'),
     client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'),
@@ -37,6 +62,17 @@ sp_oauth = SpotifyOAuth(
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# Keep the shared new-release / new-artist candidates warm so pool builds never wait on them
+if os.getenv('SPOTIFY_CLIENT_ID') and os.getenv('SPOTIFY_CLIENT_SECRET'):
+    app_credentials = SpotifyClientCredentials(
+        client_id=os.getenv('SPOTIFY_CLIENT_ID'),
+        client_secret=os.getenv('SPOTIFY_CLIENT_SECRET')
+    )
+    start_candidate_refresher(
+        lambda: spotipy.Spotify(auth_manager=app_credentials, requests_session=spotify_requests_session()),
+        [market.strip() for market in os.getenv('CANDIDATE_MARKETS', 'US').split(',') if market.strip()]
+    )
+
 # Set up logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -59,9 +95,8 @@ def safe_float(value, default=50.0):
         logger.warning(f"Could not convert {value} to float, using default {default}")
         return default
 
-def get_spotify_client():
-    """Retrieve or refresh the Spotify client token and create a Spotify client."""
-    app.logger.debug("Entering get_spotify_client function")
+def get_access_token():
+    """Retrieve the Spotify access token from the session, refreshing it if it is about to expire."""
     token_info = session.get('token_info', None)
     
     if not token_info:
@@ -84,9 +119,31 @@ def get_spotify_client():
             app.logger.error(f"Error refreshing token: {str(e)}")
             return None
 
-    access_token = token_info['access_token']
+    return token_info['access_token']
+
+def get_pool_id():
+    """Return the id of this session's data in pool_store, allocating one on first use."""
+    pool_id = session.get('pool_id')
+    if not pool_id:
+        pool_id = session['pool_id'] = uuid.uuid4().hex
+    return pool_id
+
+def get_spotify_client():
+    """Retrieve or refresh the Spotify client token and create a Spotify client."""
+    app.logger.debug("Entering get_spotify_client function")
+    access_token = get_access_token()
+    if not access_token:
+        return None
+
     app.logger.debug("Spotify client created successfully")
-    return spotipy.Spotify(auth=access_token)
+    return spotipy.Spotify(auth=access_token, requests_session=spotify_requests_session())
+
+def get_async_spotify_client():
+    """Create an AsyncSpotify client on the shared connection pool if async Spotify access is enabled."""
+    if not app.config['SPOTIFY_ASYNC']:
+        return None
+    access_token = get_access_token()
+    return AsyncSpotify(access_token) if access_token else None
 
 @app.route('/')
 def index():
@@ -179,8 +236,10 @@ def save_playlist():
         flash('Unable to authenticate with Spotify', 'danger')
         return redirect(url_for('index'))
 
-    recommended_tracks = session.get('recommended_tracks')
-    ai_playlist_description = session.get('ai_playlist_description')
+    pool_id = session.get('pool_id')
+    recommended_tracks = pool_store.get(pool_id, 'recommended_tracks')
+    ai_playlist_description = pool_store.get(pool_id, 'ai_playlist_description')
+    spotify_track_ids = pool_store.get(pool_id, 'spotify_track_ids')
     form_data = session.get('form_data')
 
     if not all([recommended_tracks, ai_playlist_description, form_data]):
@@ -188,7 +247,12 @@ def save_playlist():
         return redirect(url_for('initial_form'))
 
     try:
-        selected_tracks = find_tracks_on_spotify(sp, recommended_tracks)
+        # generate_playlist already resolved the recommendations; only search again if that result is gone
+        if spotify_track_ids is not None:
+            selected_tracks = spotify_track_ids
+        else:
+            track_pool = pool_store.get(pool_id, 'track_pool', type=List[TrackRecord], default=[])
+            selected_tracks = find_tracks_on_spotify(sp, recommended_tracks, track_pool)
 
         user_id = sp.current_user()['id']
         playlist_name = f"MoodWave: {form_data.get('activity', 'Custom').capitalize()} - {form_data.get('energy_level', 'Medium')} Energy"
@@ -210,6 +274,8 @@ def save_playlist():
 def sign_out():
     """Sign out the user and clear the session."""
     app.logger.debug("Sign out route called")
+    if session.get('pool_id'):
+        pool_store.delete(session['pool_id'])
     session.clear()
     app.logger.info("Session cleared")
     return redirect(url_for('index'))
@@ -229,18 +295,24 @@ def load_user_preferences():
         form_data = session.get('form_data', {})
         app.logger.debug(f"Retrieved form data from session: {form_data}")
 
-        # Get user profile
-        user_profile = get_user_profile(sp)
-        app.logger.debug(f"User profile retrieved: {user_profile}")
+        asp = get_async_spotify_client()
+        if asp:
+            # Profile, top artists, top genres and recent plays in one concurrent round
+            user_profile, top_artists, top_genres, recent_tracks = run_async(fetch_user_preferences_async(asp))
+        else:
+            # Get user profile
+            user_profile = get_user_profile(sp)
+
+            # Get top artists and genres
+            top_artists = get_user_top_artists(sp, limit=10)
+            top_genres = get_user_top_genres(sp, limit=10)
 
-        # Get top artists and genres
-        top_artists = get_user_top_artists(sp, limit=10)
-        top_genres = get_user_top_genres(sp, limit=10)
+            # Get recently played tracks
+            recent_tracks = sp.current_user_recently_played(limit=20)['items']
+        recent_tracks = [track_record_from_spotify(item['track']) for item in recent_tracks if item.get('track')]
+        app.logger.debug(f"User profile retrieved: {user_profile}")
         app.logger.debug(f"Top artists: {top_artists}")
         app.logger.debug(f"Top genres: {top_genres}")
-
-        # Get recently played tracks
-        recent_tracks = sp.current_user_recently_played(limit=20)['items']
         app.logger.debug(f"Recent tracks retrieved: {len(recent_tracks)}")
 
         # Get "Way Back Machine" tracks
@@ -251,13 +323,15 @@ def load_user_preferences():
         playlist_picks = get_playlist_picks(sp, limit=10)
         app.logger.debug(f"Playlist picks retrieved: {len(playlist_picks)}")
 
-        # Store all fetched tracks in the session
-        session['top_artists'] = top_artists
-        session['top_genres'] = top_genres
-        session['recent_tracks'] = recent_tracks
-        session['wayback_tracks'] = wayback_tracks
-        session['playlist_picks'] = playlist_picks
-        app.logger.debug("All track data stored in session")
+        # Store all fetched tracks in the pool store
+        pool_store.put_many(get_pool_id(), {
+            'top_artists': top_artists,
+            'top_genres': top_genres,
+            'recent_tracks': recent_tracks,
+            'wayback_tracks': wayback_tracks,
+            'playlist_picks': playlist_picks
+        })
+        app.logger.debug("All track data stored in pool store")
 
         return render_template('user_preferences.html',
                                user_profile=user_profile,
@@ -296,7 +370,7 @@ def find_tracks():
         # Limit to 200 tracks
         all_tracks = all_tracks[:200]
 
-        session['all_tracks'] = all_tracks
+        pool_store.put(get_pool_id(), 'all_tracks', all_tracks)
 
         return render_template('tracks_found.html', 
                                num_tracks=len(all_tracks),
@@ -361,13 +435,14 @@ def debug_track_pool():
             user_preferences['selected_artists'], 
             user_preferences['selected_genres'], 
             sp.me(),
-            discovery_ratio=user_preferences['discovery_level']
+            discovery_ratio=user_preferences['discovery_level'],
+            include_audio_analysis=True
         )
         
         # Prepare data for logging
         debug_data = {
-            "familiar_tracks": familiar_tracks,
-            "discovery_tracks": discovery_tracks,
+            "familiar_tracks": [track.to_dict() for track in familiar_tracks],
+            "discovery_tracks": [track.to_dict() for track in discovery_tracks],
             "user_preferences": user_preferences
         }
 
@@ -387,6 +462,20 @@ def debug_track_pool():
         return jsonify({"success": False, "message": str(e)}), 500
     
 
+@app.route('/debug_cache_stats', methods=['GET'])
+def debug_cache_stats():
+    """Report hit, miss and eviction counters for the helpers' API cache."""
+    return jsonify(cache.stats())
+
+@app.route('/debug_spotify_stats', methods=['GET'])
+def debug_spotify_stats():
+    """Report how Spotify traffic is being shaped in this worker."""
+    return jsonify({
+        "single_flight": spotify_single_flight.stats(),
+        "rate_limiter": spotify_limiter.stats(),
+        "concurrency": spotify_concurrency.stats()
+    })
+
 @app.route('/generate_playlist', methods=['GET'])
 def generate_playlist():
     """Generate a playlist based on user preferences and OpenAI recommendations."""
@@ -398,37 +487,71 @@ def generate_playlist():
             flash('Unable to authenticate with Spotify', 'danger')
             return redirect(url_for('index'))
 
+        # ?regenerate=1 asks the model again instead of reusing a cached answer
+        regenerate = request.args.get('regenerate') == '1'
+        # ?draft=1 ranks the track pool locally and skips the model
+        draft = request.args.get('draft') == '1'
+
+        if app.config['OPENAI_STREAMING'] and not draft:
+            # The page follows progress from generate_playlist_stream and then opens playlist_preview
+            return render_template('playlist_streaming.html', regenerate=regenerate)
+
         initial_form_data = session.get('form_data', {})
         confirmed_preferences = session.get('confirmed_preferences', {})
-        all_tracks = session.get('track_pool', [])
+        all_tracks = pool_store.get(session.get('pool_id'), 'track_pool', type=List[TrackRecord], default=[])
 
         logger.debug(f"Initial form data: {initial_form_data}")
         logger.debug(f"Confirmed preferences: {confirmed_preferences}")
         logger.debug(f"Track pool size: {len(all_tracks)}")
 
         user_preferences = process_user_preferences(initial_form_data, confirmed_preferences)
+        num_tracks = int(safe_float(initial_form_data.get('duration', 30)))
 
-        try:
-            openai_response = get_openai_recommendations(
-                client, 
-                user_preferences, 
-                all_tracks, 
-                num_tracks=int(safe_float(initial_form_data.get('duration', 30)))
+        recommended_tracks = []
+        resolution_stats = Counter()
+        if not draft:
+            try:
+                # Only the tracks most relevant to this request go into the prompt
+                prompt_tracks = prefilter_prompt_tracks(all_tracks, user_preferences)
+                openai_response = get_openai_recommendations(
+                    client, 
+                    user_preferences, 
+                    prompt_tracks, 
+                    num_tracks=num_tracks,
+                    regenerate=regenerate
+                )
+                logger.debug(f"Raw OpenAI response: {openai_response}")
+                recommended_tracks, ai_playlist_description, explanation = parse_openai_response(openai_response, resolution_stats)
+                recommended_tracks = expand_prompt_tracks(recommended_tracks, prompt_tracks)
+            except Exception as e:
+                logger.error(f"Error getting OpenAI recommendations: {str(e)}", exc_info=True)
+
+            if not recommended_tracks:
+                logger.warning("No recommendations from OpenAI, falling back to the local ranker")
+                flash('Recommendations are unavailable right now, so this playlist was ranked from your track pool instead.', 'info')
+
+        if not recommended_tracks:
+            recommended_tracks, ai_playlist_description, explanation = get_local_recommendations(
+                user_preferences, all_tracks, num_tracks
             )
-            logger.debug(f"Raw OpenAI response: {openai_response}")
-            
-        except Exception as e:
-            logger.error(f"Error getting OpenAI recommendations: {str(e)}", exc_info=True)
-            flash('Error generating playlist recommendations. Please try again.', 'danger')
-            return redirect(url_for('load_user_preferences'))
+            if not recommended_tracks:
+                flash('Error generating playlist recommendations. Please try again.', 'danger')
+                return redirect(url_for('load_user_preferences'))
 
-        recommended_tracks, ai_playlist_description, explanation = parse_openai_response(openai_response)
-        spotify_track_ids = find_tracks_on_spotify(sp, recommended_tracks)
+        asp = get_async_spotify_client()
+        if asp:
+            spotify_track_ids = run_async(find_tracks_on_spotify_async(asp, recommended_tracks, all_tracks, resolution_stats))
+        else:
+            spotify_track_ids = find_tracks_on_spotify(sp, recommended_tracks, all_tracks, resolution_stats)
+        logger.info(f"Track resolution: {dict(resolution_stats)}")
 
-        session['recommended_tracks'] = recommended_tracks
-        session['ai_playlist_description'] = ai_playlist_description
-        session['explanation'] = explanation
-        session['spotify_track_ids'] = spotify_track_ids
+        pool_store.put_many(get_pool_id(), {
+            'recommended_tracks': recommended_tracks,
+            'ai_playlist_description': ai_playlist_description,
+            'explanation': explanation,
+            'spotify_track_ids': spotify_track_ids,
+            'resolution_stats': dict(resolution_stats)
+        })
 
         logger.info("Successfully generated playlist. Rendering preview.")
         return render_template('playlist_preview.html',
@@ -441,6 +564,99 @@ def generate_playlist():
         flash('An unexpected error occurred. Please try again.', 'danger')
         return redirect(url_for('load_user_preferences'))
 
+def sse_event(event, data):
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/generate_playlist_stream', methods=['GET'])
+def generate_playlist_stream():
+    """Stream playlist generation as server-sent events, resolving each track on Spotify as the model writes it.
+
+    Results go to the pool store rather than the session, because the session has already
+    been saved by the time the stream body runs.
+    """
+    logger.info("Entering generate_playlist_stream function")
+    sp = get_spotify_client()
+    if not sp:
+        logger.error("Failed to get Spotify client")
+        return Response(sse_event('failed', {"message": "Unable to authenticate with Spotify"}), mimetype='text/event-stream')
+
+    initial_form_data = session.get('form_data', {})
+    confirmed_preferences = session.get('confirmed_preferences', {})
+    pool_id = get_pool_id()
+    all_tracks = pool_store.get(pool_id, 'track_pool', type=List[TrackRecord], default=[])
+    user_preferences = process_user_preferences(initial_form_data, confirmed_preferences)
+    num_tracks = int(safe_float(initial_form_data.get('duration', 30)))
+    regenerate = request.args.get('regenerate') == '1'
+    asp = get_async_spotify_client()
+
+    def local_fallback():
+        """Store a locally ranked playlist when the model fails or returns nothing usable."""
+        logger.warning("No recommendations from OpenAI, falling back to the local ranker")
+        recommended_tracks, ai_playlist_description, explanation = get_local_recommendations(
+            user_preferences, all_tracks, num_tracks
+        )
+        if not recommended_tracks:
+            return sse_event('failed', {"message": "Error generating playlist recommendations. Please try again."})
+        pool_store.put_many(pool_id, {
+            'recommended_tracks': recommended_tracks,
+            'ai_playlist_description': ai_playlist_description,
+            'explanation': explanation,
+            'spotify_track_ids': [track['spotify_id'] for track in recommended_tracks],
+            'resolution_stats': {'local': len(recommended_tracks)}
+        })
+        return sse_event('done', {"redirect": url_for('playlist_preview')})
+
+    def events():
+        try:
+            prompt_tracks = prefilter_prompt_tracks(all_tracks, user_preferences)
+            chunks = stream_openai_recommendations(client, user_preferences, prompt_tracks, num_tracks, regenerate=regenerate)
+            for event in stream_and_resolve_tracks(sp, chunks, all_tracks, asp=asp, prompt_tracks=prompt_tracks):
+                if event['event'] != 'done':
+                    yield sse_event(event['event'], event)
+                    continue
+
+                if not event['tracks']:
+                    yield local_fallback()
+                    return
+
+                logger.debug(f"Raw OpenAI response: {event['response']}")
+                resolution_stats = Counter(event['resolution_stats'])
+                _, ai_playlist_description, explanation = parse_openai_response(event['response'], resolution_stats)
+                logger.info(f"Track resolution: {dict(resolution_stats)}")
+                pool_store.put_many(pool_id, {
+                    'recommended_tracks': event['tracks'],
+                    'ai_playlist_description': ai_playlist_description,
+                    'explanation': explanation,
+                    'spotify_track_ids': event['spotify_track_ids'],
+                    'resolution_stats': dict(resolution_stats)
+                })
+                logger.info("Successfully generated playlist. Redirecting to preview.")
+                yield sse_event('done', {"redirect": url_for('playlist_preview')})
+        except Exception as e:
+            logger.error(f"Unexpected error in generate_playlist_stream: {str(e)}", exc_info=True)
+            try:
+                yield local_fallback()
+            except Exception as e:
+                logger.error(f"Local ranker fallback failed: {str(e)}", exc_info=True)
+                yield sse_event('failed', {"message": "An unexpected error occurred. Please try again."})
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/playlist_preview', methods=['GET'])
+def playlist_preview():
+    """Render the most recently generated playlist from the pool store."""
+    pool_id = session.get('pool_id')
+    recommended_tracks = pool_store.get(pool_id, 'recommended_tracks')
+    if not recommended_tracks:
+        flash('No generated playlist found. Please start over.', 'danger')
+        return redirect(url_for('initial_form'))
+    return render_template('playlist_preview.html',
+                           recommended_tracks=recommended_tracks,
+                           ai_playlist_description=pool_store.get(pool_id, 'ai_playlist_description', default=''),
+                           explanation=pool_store.get(pool_id, 'explanation', default=''))
+
 @app.route('/confirm_preferences', methods=['POST'])
 def confirm_preferences():
     """Confirm user preferences and store them in session."""
@@ -468,9 +684,12 @@ def dump_session_data():
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"logs/session_dump_{timestamp}.json"
 
-        # Dump the session data to a file
+        # Dump the session data, and the bulk data it references, to a file
+        session_data = dict(session)
+        if session.get('pool_id'):
+            session_data['pool'] = pool_store.load(session['pool_id'])
         with open(filename, 'w') as f:
-            json.dump(dict(session), f, indent=2, default=str)
+            json.dump(session_data, f, indent=2, default=str)
 
         app.logger.info(f"Session data dumped to {filename}")
         return jsonify({"success": True, "message": f"Data dumped to {filename}"})
@@ -503,16 +722,21 @@ def prepare_track_pool():
             user_preferences['selected_artists'], 
             user_preferences['selected_genres'], 
             sp.me(),
-            discovery_ratio=user_preferences['discovery_level']
+            discovery_ratio=user_preferences['discovery_level'],
+            include_audio_analysis=True,
+            asp=get_async_spotify_client()
         )
         
         logger.debug(f"Generated track pool - Familiar tracks: {len(familiar_tracks)}, Discovery tracks: {len(discovery_tracks)}")
 
         all_tracks = combine_and_deduplicate_tracks(familiar_tracks, discovery_tracks, user_preferences['discovery_level'])
 
-        session['track_pool'] = all_tracks
-        logger.info("Track pool prepared and stored in session")
+        pool_store.put(get_pool_id(), 'track_pool', all_tracks)
+        logger.info("Track pool prepared and stored in pool store")
 
+        # ?draft=1 carries through to an instant, locally ranked playlist
+        if request.args.get('draft') == '1':
+            return redirect(url_for('generate_playlist', draft=1))
         return redirect(url_for('generate_playlist'))
 
     except Exception as e:
@@ -588,13 +812,13 @@ def process_user_preferences(initial_form_data, confirmed_preferences):
 def combine_and_deduplicate_tracks(familiar_tracks, discovery_tracks, discovery_ratio):
     """Combine and deduplicate familiar and discovery tracks."""
     all_tracks = familiar_tracks + discovery_tracks
-    all_tracks = list({track['id']: track for track in all_tracks}.values())
+    all_tracks = list({track.id: track for track in all_tracks}.values())
 
     discovery_count = int(200 * discovery_ratio)
     familiar_count = 200 - discovery_count
     all_tracks = (
-        sorted(familiar_tracks, key=lambda x: x.get('discovery_score', 0))[:familiar_count] +
-        sorted(discovery_tracks, key=lambda x: x.get('discovery_score', 0), reverse=True)[:discovery_count]
+        sorted(familiar_tracks, key=lambda x: x.discovery_score or 0)[:familiar_count] +
+        sorted(discovery_tracks, key=lambda x: x.discovery_score or 0, reverse=True)[:discovery_count]
     )
 
     logger.debug(f"Final track pool size: {len(all_tracks)}")
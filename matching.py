@@ -0,0 +1,78 @@
+import re
+import difflib
+import unicodedata
+from collections import defaultdict
+
+# Minimum difflib similarity for a fuzzy title or artist match
+FUZZY_MATCH_CUTOFF = 0.88
+
+_BRACKETED_EXTRA = re.compile(r'\s*[\(\[][^\)\]]*\b(feat|ft|featuring|with|remaster|remastered)\b[^\)\]]*[\)\]]', re.IGNORECASE)
+_TRAILING_FEATURE = re.compile(r'\s+(feat|ft|featuring)\b\.?\s.*$', re.IGNORECASE)
+_TRAILING_REMASTER = re.compile(r'\s+-\s+[^-]*\bremaster(ed)?\b.*$', re.IGNORECASE)
+_ARTIST_SEPARATORS = re.compile(r'\s*(?:,|&|\bfeat\b\.?|\bft\b\.?|\bfeaturing\b)\s*', re.IGNORECASE)
+_NON_WORD = re.compile(r'[^\w\s]')
+_SPACES = re.compile(r'\s+')
+
+def _fold(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+    return _SPACES.sub(' ', _NON_WORD.sub(' ', text)).strip()
+
+def normalize_title(title):
+    """Case-fold a track title and drop featured-artist and remaster suffixes."""
+    title = _BRACKETED_EXTRA.sub('', title or '')
+    title = _TRAILING_REMASTER.sub('', title)
+    title = _TRAILING_FEATURE.sub('', title)
+    return _fold(title)
+
+def normalize_artist(artist):
+    return _fold(artist)
+
+def resolution_key(title, artist):
+    """Key under which a recommendation's resolution is shared between users."""
+    return normalize_title(title), normalize_artist(artist)
+
+def split_artists(artist):
+    """Split an artist credit such as "A feat. B" or "A & B" into normalized names."""
+    return [name for name in (_fold(part) for part in _ARTIST_SEPARATORS.split(artist or '')) if name]
+
+class TrackPoolIndex:
+    """Normalized (title, artist) index over a track pool, to resolve recommendations without a search.
+
+    Exact matches on the normalized title and any credited artist are tried first, then
+    difflib fuzzy matches on the title among that artist's tracks.
+    """
+
+    def __init__(self, tracks):
+        self._exact = {}
+        self._titles_by_artist = defaultdict(dict)
+        for track in tracks:
+            title = normalize_title(track.name)
+            for artist_name in track.artist_names:
+                artist = normalize_artist(artist_name)
+                self._exact.setdefault((title, artist), track)
+                self._titles_by_artist[artist].setdefault(title, track)
+
+    def __len__(self):
+        return len(self._exact)
+
+    def lookup(self, title, artist):
+        """Return (track, fuzzy) for the best pool match, or (None, False)."""
+        title = normalize_title(title)
+        artists = [normalize_artist(artist)] + split_artists(artist)
+        for name in artists:
+            track = self._exact.get((title, name))
+            if track is not None:
+                return track, False
+
+        for name in artists:
+            candidates = self._titles_by_artist.get(name)
+            if candidates is None:
+                close_artists = difflib.get_close_matches(name, self._titles_by_artist.keys(), n=1, cutoff=FUZZY_MATCH_CUTOFF)
+                if not close_artists:
+                    continue
+                candidates = self._titles_by_artist[close_artists[0]]
+            close_titles = difflib.get_close_matches(title, candidates.keys(), n=1, cutoff=FUZZY_MATCH_CUTOFF)
+            if close_titles:
+                return candidates[close_titles[0]], True
+        return None, False
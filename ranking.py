@@ -0,0 +1,266 @@
+import os
+import re
+import time
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger('helpers')
+
+# Ordinal position of each analyze_audio_features tempo category
+TEMPO_CATEGORIES = ["Very Slow", "Slow", "Moderate", "Fast", "Very Fast"]
+# Words in the free-text activity that point at each suitable_activities label
+ACTIVITY_KEYWORDS = {
+    "Dancing": ("danc", "club"),
+    "Working Out": ("work out", "workout", "gym", "run", "exercis", "training", "cardio", "lift"),
+    "Relaxing": ("relax", "chill", "unwind", "rest", "sleep", "meditat", "calm"),
+    "Studying": ("study", "studying", "focus", "read", "coding", "homework"),
+    "Partying": ("party", "parties", "celebrat", "pregame"),
+}
+# Weight of each squared distance term; features are scaled to [0, 1] first
+RANKING_WEIGHTS = {
+    'happiness': 1.0,
+    'energy': 1.0,
+    'relaxation': 0.4,
+    'tempo': 0.4,
+    'discovery': 0.6,
+    'activity': 0.5,
+    'time_of_day': 0.3,
+    'unanalyzed': 0.5,
+}
+# Estimated prompt tokens the candidate track table may use; decides how many tracks the model sees
+PROMPT_TRACK_TOKEN_BUDGET = int(os.getenv('PROMPT_TRACK_TOKEN_BUDGET', 600))
+# Share of the pre-filter score that comes from text relevance rather than audio fit
+PREFILTER_RELEVANCE_WEIGHT = float(os.getenv('PREFILTER_RELEVANCE_WEIGHT', 0.5))
+# spaCy pipeline with word vectors; without it relevance falls back to token overlap
+SPACY_MODEL = os.getenv('SPACY_MODEL', 'en_core_web_md')
+
+_nlp = None
+_nlp_loaded = False
+_nlp_lock = threading.Lock()
+_WORDS = re.compile(r'\w+')
+
+def match_activities(activity):
+    """Map the user's free-text activity to the suitable_activities labels it implies."""
+    text = (activity or '').casefold()
+    return {
+        label for label, keywords in ACTIVITY_KEYWORDS.items()
+        if any(re.search(r'\b' + re.escape(keyword), text) for keyword in keywords)
+    }
+
+def ranking_target(user_preferences):
+    """Feature values an ideal track would have for these preferences, on a 0-100 scale."""
+    energy_level = user_preferences['energy_level']
+    return {
+        # Lean towards where the user wants to end up, starting from where they are
+        'happiness': 0.25 * user_preferences['current_mood'] + 0.75 * user_preferences['desired_mood'],
+        'energy': energy_level,
+        'relaxation': 100 - energy_level,
+        'tempo': energy_level / 100 * (len(TEMPO_CATEGORIES) - 1),
+        'discovery': user_preferences['discovery_level'] * 100
+    }
+
+def build_ranking_columns(tracks, activities, time_of_day):
+    """Columns of the features the ranker compares; tracks without audio analysis get neutral values."""
+    count = len(tracks)
+    columns = {name: np.full(count, 50.0) for name in ('happiness', 'energy', 'relaxation', 'discovery')}
+    columns['tempo'] = np.full(count, (len(TEMPO_CATEGORIES) - 1) / 2)
+    columns['activity'] = np.zeros(count, dtype=bool)
+    columns['time_of_day'] = np.zeros(count, dtype=bool)
+    columns['analyzed'] = np.zeros(count, dtype=bool)
+    tempo_positions = {category: i for i, category in enumerate(TEMPO_CATEGORIES)}
+
+    for i, track in enumerate(tracks):
+        if track.discovery_score is not None:
+            columns['discovery'][i] = track.discovery_score * 100
+        analysis = track.audio_analysis
+        if analysis is None:
+            continue
+        columns['analyzed'][i] = True
+        columns['happiness'][i] = analysis.happiness
+        columns['energy'][i] = analysis.energy
+        columns['relaxation'][i] = analysis.relaxation
+        columns['tempo'][i] = tempo_positions.get(analysis.tempo_category, columns['tempo'][i])
+        columns['activity'][i] = bool(activities.intersection(analysis.suitable_activities))
+        columns['time_of_day'][i] = analysis.best_time_of_day == time_of_day
+    return columns
+
+def rank_tracks(tracks, user_preferences, num_tracks=30):
+    """Pick the num_tracks pool tracks closest to the target implied by the preferences.
+
+    Each track is scored by weighted distance to ranking_target(), with penalties for
+    not suiting the activity or time of day and for missing audio analysis. Ties keep
+    pool order, so the same pool and preferences always give the same playlist. The
+    picks are ordered so happiness moves from the current mood towards the desired one.
+    Returns (track, distance) pairs.
+    """
+    if not tracks:
+        return []
+    distance, columns = ranking_distances(tracks, user_preferences)
+
+    picks = []
+    seen = set()
+    for i in np.argsort(distance, kind='stable'):
+        if tracks[i].id in seen:
+            continue
+        seen.add(tracks[i].id)
+        picks.append(i)
+        if len(picks) == num_tracks:
+            break
+
+    rising = user_preferences['desired_mood'] >= user_preferences['current_mood']
+    picks.sort(key=lambda i: columns['happiness'][i], reverse=not rising)
+    return [(tracks[i], float(distance[i])) for i in picks]
+
+def ranking_distances(tracks, user_preferences):
+    """Weighted distance of every track to the preference target, with the feature columns used."""
+    target = ranking_target(user_preferences)
+    activities = match_activities(user_preferences.get('activity'))
+    columns = build_ranking_columns(tracks, activities, user_preferences.get('time_of_day'))
+    w = RANKING_WEIGHTS
+
+    distance = (
+        w['happiness'] * ((columns['happiness'] - target['happiness']) / 100) ** 2
+        + w['energy'] * ((columns['energy'] - target['energy']) / 100) ** 2
+        + w['relaxation'] * ((columns['relaxation'] - target['relaxation']) / 100) ** 2
+        + w['tempo'] * ((columns['tempo'] - target['tempo']) / (len(TEMPO_CATEGORIES) - 1)) ** 2
+        + w['discovery'] * ((columns['discovery'] - target['discovery']) / 100) ** 2
+        + w['time_of_day'] * ~columns['time_of_day']
+        + w['unanalyzed'] * ~columns['analyzed']
+    )
+    if activities:
+        distance = distance + w['activity'] * ~columns['activity']
+    return distance, columns
+
+def ranking_reason(track, activities, time_of_day):
+    """Short explanation of why the ranker picked a track."""
+    analysis = track.audio_analysis
+    if analysis is None:
+        return "Picked for how well it fits your discovery level"
+    reason = f"Energy {analysis.energy:.0f}, happiness {analysis.happiness:.0f}, {analysis.tempo_category.lower()} tempo"
+    matched = activities.intersection(analysis.suitable_activities)
+    if matched:
+        reason += f", good for {', '.join(sorted(matched)).lower()}"
+    if analysis.best_time_of_day == time_of_day:
+        reason += f", suits the {time_of_day.lower()}"
+    return reason
+
+def get_local_recommendations(user_preferences, tracks, num_tracks=30):
+    """Build a playlist from the track pool alone, without the model.
+
+    Returns (recommended_tracks, playlist_description, explanation) in the shape of
+    parse_openai_response; every track carries its spotify_id, so none needs a search.
+    """
+    started = time.perf_counter()
+    activities = match_activities(user_preferences.get('activity'))
+    time_of_day = user_preferences.get('time_of_day') or ''
+    ranked = rank_tracks(tracks, user_preferences, num_tracks)
+    recommended_tracks = [
+        {
+            'name': track.name,
+            'artist': track.artist,
+            'reason': ranking_reason(track, activities, time_of_day),
+            'spotify_id': track.id
+        }
+        for track, _ in ranked
+    ]
+    logger.info(f"Ranked {len(recommended_tracks)} of {len(tracks)} pool tracks locally in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    activity = user_preferences.get('activity') or 'your day'
+    playlist_description = (
+        f"{len(recommended_tracks)} tracks from your pool for {activity.lower()}"
+        + (f" in the {time_of_day.lower()}" if time_of_day else "")
+        + f", moving your mood from {user_preferences['current_mood']:.0f} towards {user_preferences['desired_mood']:.0f}"
+        + f" at an energy level of {user_preferences['energy_level']:.0f}."
+    )
+    explanation = (
+        "This playlist was ranked directly from the audio analysis of your track pool: each track was "
+        "scored by how closely its happiness, energy, relaxation and tempo match your mood and energy "
+        "targets, how well it suits your activity and time of day, and how close its discovery score is "
+        "to your discovery level."
+    )
+    return recommended_tracks, playlist_description, explanation
+
+def get_nlp():
+    """Load the spaCy pipeline once; returns None when spaCy or a model with vectors is unavailable."""
+    global _nlp, _nlp_loaded
+    with _nlp_lock:
+        if not _nlp_loaded:
+            _nlp_loaded = True
+            try:
+                import spacy
+                nlp = spacy.load(SPACY_MODEL, disable=['parser', 'ner', 'lemmatizer', 'tagger', 'attribute_ruler'])
+                if nlp.vocab.vectors.shape[0]:
+                    _nlp = nlp
+                else:
+                    logger.warning(f"spaCy model {SPACY_MODEL} has no word vectors; using token overlap for relevance")
+            except Exception as e:
+                logger.warning(f"spaCy model {SPACY_MODEL} unavailable, using token overlap for relevance: {str(e)}")
+    return _nlp
+
+def track_text(track):
+    """Words describing a track for relevance scoring."""
+    parts = [track.name] + list(track.artist_names)
+    analysis = track.audio_analysis
+    if analysis is not None:
+        parts += list(analysis.suitable_activities) + [analysis.best_time_of_day, analysis.tempo_category]
+    return ' '.join(parts)
+
+def text_relevance(query, texts):
+    """Similarity in [0, 1] of each text to the query: spaCy vector cosine, or token overlap without spaCy."""
+    relevance = np.zeros(len(texts))
+    if not query.strip() or not texts:
+        return relevance
+
+    nlp = get_nlp()
+    if nlp is not None:
+        query_vector = nlp(query).vector
+        vectors = np.array([doc.vector for doc in nlp.pipe(texts)])
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
+        if norms.any():
+            cosine = np.divide(vectors @ query_vector, norms, out=np.zeros(len(texts)), where=norms > 0)
+            return np.clip(cosine, 0, 1)
+
+    query_words = set(_WORDS.findall(query.casefold()))
+    for i, text in enumerate(texts):
+        words = set(_WORDS.findall(text.casefold()))
+        if words:
+            relevance[i] = len(query_words & words) / (len(query_words) * len(words)) ** 0.5
+    return relevance
+
+def estimate_tokens(text):
+    """Rough token count for budgeting (about four characters per token)."""
+    return len(text) // 4 + 1
+
+def prefilter_prompt_tracks(tracks, user_preferences, token_budget=PROMPT_TRACK_TOKEN_BUDGET):
+    """Order the pool by relevance to the request and keep as many tracks as fit the token budget.
+
+    Relevance blends text similarity between the playlist description and activity and each
+    track's name, artists and suitable activities with the audio fit from ranking_distances().
+    The result is deterministic for a given pool and preferences, so the prompt cache still hits.
+    """
+    if not tracks:
+        return []
+    started = time.perf_counter()
+    query = f"{user_preferences.get('playlist_description', '')} {user_preferences.get('activity', '')}"
+    relevance = text_relevance(query, [track_text(track) for track in tracks])
+    distance, _ = ranking_distances(tracks, user_preferences)
+    fit = 1 / (1 + distance)
+    scores = PREFILTER_RELEVANCE_WEIGHT * relevance + (1 - PREFILTER_RELEVANCE_WEIGHT) * fit
+
+    selected = []
+    seen = set()
+    used = 0
+    for i in np.argsort(-scores, kind='stable'):
+        track = tracks[i]
+        if track.id in seen:
+            continue
+        cost = estimate_tokens(f"{len(selected) + 1}|{track.name}|{track.artist}|000|000|000|000")
+        if used + cost > token_budget:
+            break
+        seen.add(track.id)
+        selected.append(track)
+        used += cost
+    logger.info(f"Pre-filtered prompt pool to {len(selected)} of {len(tracks)} tracks (~{used} tokens) in {(time.perf_counter() - started) * 1000:.1f} ms")
+    return selected
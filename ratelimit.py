@@ -0,0 +1,322 @@
+import os
+import time
+import logging
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from caching import connect_redis, REDIS_KEY_PREFIX
+
+logger = logging.getLogger('helpers')
+
+# Sustained Spotify requests per second for this process (or for all processes when shared)
+SPOTIFY_RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', 10))
+# Requests that may go out back to back before the rate applies
+SPOTIFY_RATE_BURST = int(os.getenv('SPOTIFY_RATE_BURST', 20))
+# Share one budget between every worker through Redis
+SPOTIFY_RATE_LIMIT_SHARED = os.getenv('SPOTIFY_RATE_LIMIT_SHARED', '').lower() in ('1', 'true', 'yes')
+# Number of recent queue times kept for the percentile in stats()
+QUEUE_TIME_WINDOW = 1000
+# Bounds and starting point for in-flight Spotify requests per process
+SPOTIFY_MIN_CONCURRENCY = int(os.getenv('SPOTIFY_MIN_CONCURRENCY', 1))
+SPOTIFY_INITIAL_CONCURRENCY = int(os.getenv('SPOTIFY_INITIAL_CONCURRENCY', 4))
+SPOTIFY_MAX_CONCURRENCY = int(os.getenv('SPOTIFY_MAX_CONCURRENCY', 32))
+
+def retry_after_seconds(headers, default=1):
+    """Parse a Retry-After header into seconds."""
+    try:
+        return max(float(headers.get('Retry-After', default)), 0)
+    except (TypeError, ValueError):
+        return default
+
+class RateLimiter(ABC):
+    """Token bucket in GCRA form: each request reserves the next slot in a schedule.
+
+    reserve() takes a token and returns how long the caller must wait before using it, so
+    threads can sleep and coroutines can await against the same budget. pause() pushes the
+    schedule past a Retry-After so every caller holds back once, after which requests are
+    released at the normal rate. Queue times are recorded for stats().
+    """
+
+    # Whether reserve() and pause() make network round trips
+    blocking = False
+
+    def __init__(self, rate=SPOTIFY_RATE_LIMIT, burst=SPOTIFY_RATE_BURST):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (self.burst - 1)
+        self._stats_lock = threading.Lock()
+        self._queue_times = deque(maxlen=QUEUE_TIME_WINDOW)
+        self.requests = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.pauses = 0
+
+    @abstractmethod
+    def _reserve(self):
+        """Take the next slot and return the raw wait in seconds."""
+
+    @abstractmethod
+    def _pause(self, seconds):
+        """Push the schedule back by seconds."""
+
+    def reserve(self):
+        """Take a token and return the seconds to wait before sending the request."""
+        wait = max(self._reserve(), 0.0)
+        with self._stats_lock:
+            self.requests += 1
+            self._queue_times.append(wait)
+            if wait > 0:
+                self.delayed += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    def acquire(self):
+        """Block until the next request may be sent; returns the time spent queued."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self):
+        """Async acquire(); a reservation that does network I/O runs in a thread so the event loop never blocks on it."""
+        wait = await asyncio.to_thread(self.reserve) if self.blocking else self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """Hold back every caller for seconds, e.g. after a 429 with Retry-After."""
+        logger.warning(f"Rate limited. Pausing Spotify requests for {seconds} seconds.")
+        with self._stats_lock:
+            self.pauses += 1
+        self._pause(seconds)
+
+    def stats(self):
+        with self._stats_lock:
+            queue_times = sorted(self._queue_times)
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'requests': self.requests,
+                'delayed': self.delayed,
+                'pauses': self.pauses,
+                'mean_queue_time': self.total_wait / self.requests if self.requests else 0.0,
+                'p95_queue_time': queue_times[int(len(queue_times) * 0.95)] if queue_times else 0.0,
+                'max_queue_time': self.max_wait
+            }
+
+class TokenBucket(RateLimiter):
+    """Rate limiter shared by the threads and coroutines of one process."""
+
+    def __init__(self, rate=SPOTIFY_RATE_LIMIT, burst=SPOTIFY_RATE_BURST):
+        super().__init__(rate, burst)
+        self._lock = threading.Lock()
+        # Theoretical arrival time of the next request
+        self._tat = 0.0
+
+    def _reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            tat = max(self._tat, now)
+            self._tat = tat + self.interval
+            return tat - self.tolerance - now
+
+    def _pause(self, seconds):
+        with self._lock:
+            self._tat = max(self._tat, time.monotonic() + seconds + self.tolerance)
+
+class RedisTokenBucket(RateLimiter):
+    """Rate limiter whose schedule lives in Redis, so every worker shares one budget.
+
+    Reservations run as one Lua script against Redis' clock. If Redis fails the limiter
+    falls back to a per-process TokenBucket with the same budget.
+    """
+
+    SCRIPT = """
+    local now_parts = redis.call('TIME')
+    local now = now_parts[1] * 1000 + now_parts[2] / 1000
+    local interval = tonumber(ARGV[1])
+    local tolerance = tonumber(ARGV[2])
+    local pause = tonumber(ARGV[3])
+    local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+    if tat < now then tat = now end
+    local wait = 0
+    if pause > 0 then
+        tat = math.max(tat, now + pause + tolerance)
+    else
+        wait = tat - tolerance - now
+        tat = tat + interval
+    end
+    redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil(tat - now) + 1000)
+    return tostring(wait)
+    """
+
+    blocking = True
+
+    def __init__(self, client, rate=SPOTIFY_RATE_LIMIT, burst=SPOTIFY_RATE_BURST, key=f'{REDIS_KEY_PREFIX}spotify:rate'):
+        super().__init__(rate, burst)
+        self.key = key
+        self.errors = 0
+        self._script = client.register_script(self.SCRIPT)
+        self.fallback = TokenBucket(rate, burst)
+
+    def _run(self, pause_ms):
+        return float(self._script(keys=[self.key], args=[self.interval * 1000, self.tolerance * 1000, pause_ms])) / 1000
+
+    def _reserve(self):
+        try:
+            return self._run(0)
+        except Exception as e:
+            logger.warning(f"Shared rate limiter unavailable, using local limiter: {str(e)}")
+            self.errors += 1
+            return self.fallback._reserve()
+
+    def _pause(self, seconds):
+        self.fallback._pause(seconds)
+        try:
+            self._run(seconds * 1000)
+        except Exception as e:
+            logger.warning(f"Could not pause shared rate limiter: {str(e)}")
+            self.errors += 1
+
+    def stats(self):
+        stats = super().stats()
+        stats['shared'] = True
+        stats['errors'] = self.errors
+        return stats
+
+def build_rate_limiter(redis_client=None):
+    """Build the Spotify rate limiter: shared through Redis when configured and reachable, otherwise per process."""
+    if SPOTIFY_RATE_LIMIT_SHARED:
+        redis_client = redis_client or connect_redis()
+        if redis_client is not None:
+            logger.info("Using Redis-backed Spotify rate limiter")
+            return RedisTokenBucket(redis_client)
+        logger.warning("SPOTIFY_RATE_LIMIT_SHARED is set but Redis is unavailable; limiting per process")
+    return TokenBucket()
+
+# Budget shared by every Spotify call made from this process
+spotify_limiter = build_rate_limiter()
+
+class AIMDConcurrencyLimit:
+    """Concurrency limit that adapts to the API's tolerance: additive increase, multiplicative decrease.
+
+    Every successful request raises the limit by 1/limit, i.e. about one slot per round of
+    requests; a throttled or failed request (429 or 5xx) multiplies it by backoff. Other
+    errors, such as a 404, leave the limit unchanged. Only
+    requests started after the last cut can cut again, so a burst of failures from the
+    same round counts once.
+    """
+
+    def __init__(self, initial=SPOTIFY_INITIAL_CONCURRENCY, min_limit=SPOTIFY_MIN_CONCURRENCY,
+                 max_limit=SPOTIFY_MAX_CONCURRENCY, backoff=0.5):
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.backoff = backoff
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        self.successes = 0
+        self.decreases = 0
+        self.max_in_flight = 0
+
+    def acquire(self):
+        """Wait for a free slot; returns the start time to pass back to release()."""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            return time.monotonic()
+
+    def release(self, started, throttled=False, success=True):
+        """Free a slot. Throttled requests cut the limit, successful ones grow it and other failures leave it as is."""
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                if started >= self._last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = time.monotonic()
+                    self.decreases += 1
+                    logger.info(f"Spotify concurrency limit cut to {int(self.limit)}")
+            elif success:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.successes += 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, is_throttled):
+        """Hold a slot around one request; is_throttled(exception) decides whether a failure cuts the limit."""
+        started = self.acquire()
+        throttled = False
+        success = False
+        try:
+            yield
+            success = True
+        except Exception as e:
+            throttled = is_throttled(e)
+            raise
+        finally:
+            self.release(started, throttled, success)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'limit': int(self.limit),
+                'min_limit': self.min_limit,
+                'max_limit': self.max_limit,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'successes': self.successes,
+                'decreases': self.decreases
+            }
+
+# In-flight Spotify requests for this process
+spotify_concurrency = AIMDConcurrencyLimit()
+
+class RateLimitedAdapter(HTTPAdapter):
+    """requests adapter that queues each request on a limiter and pauses the limiter on 429."""
+
+    def __init__(self, limiter, **kwargs):
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire()
+        response = super().send(request, **kwargs)
+        if response.status_code == 429:
+            self.limiter.pause(retry_after_seconds(response.headers))
+        return response
+
+def spotify_requests_session(limiter=None):
+    """Return a requests.Session for spotipy whose calls go through the rate limiter.
+
+    Connection errors and 5xx responses are retried as spotipy does by default; 429s are
+    returned straight away so the limiter, not a per-request sleep, handles Retry-After.
+    """
+    retry = Retry(
+        total=3,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=False
+    )
+    adapter = RateLimitedAdapter(limiter or spotify_limiter, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
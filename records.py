@@ -0,0 +1,143 @@
+from datetime import datetime
+from typing import List, Optional, Union
+
+import msgspec
+
+class AudioAnalysis(msgspec.Struct, array_like=True):
+    """Flattened analyze_audio_features output kept with each track."""
+    happiness: float
+    energy: float
+    relaxation: float
+    intensity: float
+    danceability: float
+    acousticness: float
+    instrumentalness: float
+    tempo: float
+    tempo_category: str
+    best_time_of_day: str
+    suitable_activities: List[str]
+    key: int
+    mode: int
+    time_signature: int
+
+    def to_dict(self):
+        """Return the nested dict shape produced by analyze_audio_features."""
+        return {
+            'mood_scores': {
+                'happiness': self.happiness,
+                'energy': self.energy,
+                'relaxation': self.relaxation,
+                'intensity': self.intensity
+            },
+            'suitable_activities': list(self.suitable_activities),
+            'best_time_of_day': self.best_time_of_day,
+            'danceability': self.danceability,
+            'acousticness': self.acousticness,
+            'instrumentalness': self.instrumentalness,
+            'tempo_category': self.tempo_category,
+            'tempo': self.tempo,
+            'key': self.key,
+            'mode': self.mode,
+            'time_signature': self.time_signature
+        }
+
+class TrackRecord(msgspec.Struct, array_like=True):
+    """The parts of a Spotify track the app uses, stored in place of the full API object.
+
+    Records are slotted and encode as bare msgpack arrays, so a pool holding hundreds of
+    them stays small. get() mirrors dict.get for code that scores or sorts
+    tracks by key.
+    """
+    id: str
+    name: str
+    artist_names: List[str]
+    artist_ids: List[str]
+    popularity: Optional[int] = None
+    duration_ms: Optional[int] = None
+    preview_url: Optional[str] = None
+    discovery_score: Optional[float] = None
+    audio_analysis: Optional[AudioAnalysis] = None
+    added_at: Optional[str] = None
+
+    @property
+    def artist(self):
+        """Primary artist name."""
+        return self.artist_names[0] if self.artist_names else ''
+
+    @property
+    def added_at_formatted(self):
+        """Library add date for display, e.g. "March 04, 2021"."""
+        if not self.added_at:
+            return ''
+        return datetime.strptime(self.added_at, "%Y-%m-%dT%H:%M:%SZ").strftime("%B %d, %Y")
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self):
+        """Return a plain dict for logs and debug dumps."""
+        data = msgspec.structs.asdict(self)
+        if self.audio_analysis is not None:
+            data['audio_analysis'] = self.audio_analysis.to_dict()
+        return data
+
+class RecommendedTrack(msgspec.Struct):
+    """One entry of the model's "tracks" array: a name and artist, or a prompt table number in id mode.
+
+    Field types are loose because models write null reasons and artist lists; to_dict()
+    normalizes them.
+    """
+    name: Optional[str] = None
+    artist: Union[str, List[str], None] = None
+    reason: Optional[str] = None
+    id: Union[int, str, None] = None
+
+    def to_dict(self):
+        """Return the recommendation dict used by the resolvers and templates."""
+        artist = ', '.join(self.artist) if isinstance(self.artist, list) else self.artist
+        track = {'name': self.name or '', 'artist': artist or '', 'reason': self.reason or ''}
+        if self.id is not None:
+            track['id'] = self.id
+        return track
+
+class Recommendations(msgspec.Struct):
+    """The JSON object the recommendation prompt asks the model for."""
+    playlist_description: Optional[str] = None
+    tracks: List[RecommendedTrack] = []
+
+def audio_analysis_from_dict(analysis):
+    """Build an AudioAnalysis from analyze_audio_features output."""
+    mood_scores = analysis['mood_scores']
+    return AudioAnalysis(
+        happiness=mood_scores['happiness'],
+        energy=mood_scores['energy'],
+        relaxation=mood_scores['relaxation'],
+        intensity=mood_scores['intensity'],
+        danceability=analysis['danceability'],
+        acousticness=analysis['acousticness'],
+        instrumentalness=analysis['instrumentalness'],
+        tempo=analysis['tempo'],
+        tempo_category=analysis['tempo_category'],
+        best_time_of_day=analysis['best_time_of_day'],
+        suitable_activities=list(analysis['suitable_activities']),
+        key=int(analysis['key']),
+        mode=int(analysis['mode']),
+        time_signature=int(analysis['time_signature'])
+    )
+
+def track_record_from_spotify(track, added_at=None):
+    """Build a TrackRecord from a Spotify track object (full or simplified) annotated by the helpers."""
+    artists = track.get('artists') or []
+    analysis = track.get('audio_analysis')
+    return TrackRecord(
+        id=track['id'],
+        name=track.get('name', ''),
+        artist_names=[artist.get('name', '') for artist in artists],
+        artist_ids=[artist.get('id') or '' for artist in artists],
+        popularity=track.get('popularity'),
+        duration_ms=track.get('duration_ms'),
+        preview_url=track.get('preview_url'),
+        discovery_score=track.get('discovery_score'),
+        audio_analysis=audio_analysis_from_dict(analysis) if analysis else None,
+        added_at=added_at
+    )
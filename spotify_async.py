@@ -0,0 +1,180 @@
+import os
+import copy
+import asyncio
+import logging
+import threading
+
+import httpx
+from spotipy.exceptions import SpotifyException
+
+from ratelimit import spotify_limiter, retry_after_seconds
+
+logger = logging.getLogger('helpers')
+
+API_PREFIX = "https://api.spotify.com/v1/"
+
+SPOTIFY_HTTP2 = os.getenv('SPOTIFY_HTTP2', '').lower() in ('1', 'true', 'yes')
+SPOTIFY_MAX_CONNECTIONS = int(os.getenv('SPOTIFY_MAX_CONNECTIONS', 20))
+SPOTIFY_ASYNC_TIMEOUT = float(os.getenv('SPOTIFY_ASYNC_TIMEOUT', 10))
+SPOTIFY_ASYNC_MAX_ATTEMPTS = 5
+
+# All async Spotify traffic runs on one background event loop so the HTTP connection
+# pool is shared by every request thread. Coroutines running on this loop must never
+# call run_async themselves.
+_loop = None
+_loop_lock = threading.Lock()
+_http_client = None
+# In-flight GET requests keyed by (token, url, params), shared by identical concurrent callers
+_in_flight = {}
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='spotify-async', daemon=True).start()
+    return _loop
+
+def run_async(coro):
+    """Run a coroutine on the shared Spotify event loop from synchronous code and return its result."""
+    return submit_async(coro).result()
+
+def submit_async(coro):
+    """Schedule a coroutine on the shared Spotify event loop and return a concurrent.futures.Future for it."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+def _http2_available():
+    if not SPOTIFY_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logger.warning("SPOTIFY_HTTP2 is set but the h2 package is not installed; using HTTP/1.1")
+        return False
+
+def get_http_client():
+    """Return the process-wide pooled httpx.AsyncClient, creating it on first use."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            base_url=API_PREFIX,
+            http2=_http2_available(),
+            timeout=SPOTIFY_ASYNC_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=SPOTIFY_MAX_CONNECTIONS,
+                max_keepalive_connections=SPOTIFY_MAX_CONNECTIONS,
+                keepalive_expiry=60
+            )
+        )
+    return _http_client
+
+class AsyncSpotify:
+    """Minimal async Spotify Web API client mirroring the spotipy methods used by the helpers.
+
+    Responses are the same JSON payloads spotipy returns, and API errors are raised as
+    SpotifyException so callers can handle both clients the same way.
+    """
+
+    def __init__(self, access_token):
+        self._auth = access_token
+
+    async def _request(self, method, url, params=None, payload=None):
+        headers = {'Authorization': f'Bearer {self._auth}'}
+        if params:
+            params = {key: value for key, value in params.items() if value is not None}
+
+        for attempt in range(1, SPOTIFY_ASYNC_MAX_ATTEMPTS + 1):
+            # Queue on the same budget as the synchronous client
+            await spotify_limiter.acquire_async()
+            response = await get_http_client().request(method, url, params=params, json=payload, headers=headers)
+            if response.status_code < 400:
+                return response.json() if response.content else None
+
+            if response.status_code == 429:
+                # The limiter holds every caller back for Retry-After, this one included
+                if spotify_limiter.blocking:
+                    await asyncio.to_thread(spotify_limiter.pause, retry_after_seconds(response.headers))
+                else:
+                    spotify_limiter.pause(retry_after_seconds(response.headers))
+                if attempt < SPOTIFY_ASYNC_MAX_ATTEMPTS:
+                    continue
+            elif response.status_code >= 500 and attempt < SPOTIFY_ASYNC_MAX_ATTEMPTS:
+                await asyncio.sleep(min(2 ** attempt, 60))
+                continue
+
+            try:
+                message = response.json().get('error', {}).get('message', response.text)
+            except ValueError:
+                message = response.text
+            logger.error(f"Spotify API error: {response.status_code} {message}")
+            raise SpotifyException(response.status_code, -1, f"{response.url}:\n {message}", headers=response.headers)
+
+    async def _get(self, url, **params):
+        """GET with single-flight: identical concurrent requests share one response."""
+        key = (self._auth, url, repr(sorted(params.items())))
+        task = _in_flight.get(key)
+        if task is not None:
+            return copy.deepcopy(await asyncio.shield(task))
+
+        task = asyncio.ensure_future(self._request('GET', url, params=params))
+        _in_flight[key] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if _in_flight.get(key) is task:
+                del _in_flight[key]
+
+    async def me(self):
+        return await self._get('me')
+
+    current_user = me
+
+    async def current_user_top_artists(self, limit=20, offset=0, time_range='medium_term'):
+        return await self._get('me/top/artists', limit=limit, offset=offset, time_range=time_range)
+
+    async def current_user_top_tracks(self, limit=20, offset=0, time_range='medium_term'):
+        return await self._get('me/top/tracks', limit=limit, offset=offset, time_range=time_range)
+
+    async def current_user_recently_played(self, limit=50, after=None, before=None):
+        return await self._get('me/player/recently-played', limit=limit, after=after, before=before)
+
+    async def current_user_playlists(self, limit=50, offset=0):
+        return await self._get('me/playlists', limit=limit, offset=offset)
+
+    async def current_user_saved_tracks(self, limit=20, offset=0, market=None):
+        return await self._get('me/tracks', limit=limit, offset=offset, market=market)
+
+    async def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None, additional_types=('track',)):
+        return await self._get(f'playlists/{playlist_id}/tracks', fields=fields, limit=limit, offset=offset,
+                               market=market, additional_types=','.join(additional_types))
+
+    async def search(self, q, limit=10, offset=0, type='track', market=None):
+        return await self._get('search', q=q, limit=limit, offset=offset, type=type, market=market)
+
+    async def new_releases(self, country=None, limit=20, offset=0):
+        return await self._get('browse/new-releases', country=country, limit=limit, offset=offset)
+
+    async def album_tracks(self, album_id, limit=50, offset=0, market=None):
+        return await self._get(f'albums/{album_id}/tracks', limit=limit, offset=offset, market=market)
+
+    async def albums(self, albums, market=None):
+        return await self._get('albums', ids=','.join(albums), market=market)
+
+    async def artists(self, artists):
+        return await self._get('artists', ids=','.join(artists))
+
+    async def artist_top_tracks(self, artist_id, country='US'):
+        return await self._get(f'artists/{artist_id}/top-tracks', country=country)
+
+    async def audio_features(self, tracks=[]):
+        results = await self._get('audio-features', ids=','.join(tracks))
+        return results.get('audio_features', []) if results else []
+
+    async def recommendation_genre_seeds(self):
+        return await self._get('recommendations/available-genre-seeds')
+
+    async def next(self, result):
+        if result.get('next'):
+            return await self._get(result['next'])
+        return None
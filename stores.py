@@ -0,0 +1,413 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+import msgspec
+
+from caching import connect_redis, REDIS_KEY_PREFIX
+
+logger = logging.getLogger('helpers')
+
+# Directory for server-side data that should survive restarts
+DATA_DIR = os.getenv('MOODWAVE_DATA_DIR', './.data/')
+# Track pools and playlist results expire this long after their last write
+POOL_STORE_TTL = int(os.getenv('POOL_STORE_TTL', 24 * 3600))
+POOL_STORE_MAX_BYTES = int(os.getenv('POOL_STORE_MAX_MB', 256)) * 1024 * 1024
+# Largest single pool kept in Redis; the instance's maxmemory policy bounds the total
+POOL_STORE_MAX_POOL_BYTES = int(os.getenv('POOL_STORE_MAX_POOL_MB', 8)) * 1024 * 1024
+# How long a resolved recommendation is trusted, and how long a known miss is, before searching again
+RESOLUTION_CACHE_TTL = int(os.getenv('RESOLUTION_CACHE_TTL', 30 * 24 * 3600))
+RESOLUTION_NOT_FOUND_TTL = int(os.getenv('RESOLUTION_NOT_FOUND_TTL', 24 * 3600))
+# How long a track Spotify returned no audio features for is skipped before asking again
+AUDIO_FEATURES_MISSING_TTL = int(os.getenv('AUDIO_FEATURES_MISSING_TTL', 24 * 3600))
+
+@contextmanager
+def _connect(path):
+    """Open a SQLite connection that can share a database file between threads and workers, committing on exit."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+class PlaylistIndexStore:
+    """Per-user inverted index of track id to the playlists containing it, keyed by playlist snapshot."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(DATA_DIR, 'playlist_index.sqlite3')
+        self._lock = threading.Lock()
+        with self._lock, _connect(self.path) as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS playlists ('
+                'user_id TEXT NOT NULL, playlist_id TEXT NOT NULL, snapshot_id TEXT, '
+                'PRIMARY KEY (user_id, playlist_id))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS playlist_tracks ('
+                'user_id TEXT NOT NULL, playlist_id TEXT NOT NULL, track_id TEXT NOT NULL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS playlist_tracks_by_playlist '
+                'ON playlist_tracks (user_id, playlist_id)'
+            )
+
+    def get_snapshots(self, user_id):
+        """Return {playlist_id: snapshot_id} for every playlist indexed for the user."""
+        with self._lock, _connect(self.path) as conn:
+            rows = conn.execute('SELECT playlist_id, snapshot_id FROM playlists WHERE user_id = ?', (user_id,))
+            return dict(rows.fetchall())
+
+    def replace_playlist(self, user_id, playlist_id, snapshot_id, track_ids):
+        """Store the full track list of a playlist at the given snapshot, replacing any older copy."""
+        with self._lock, _connect(self.path) as conn:
+            conn.execute('DELETE FROM playlist_tracks WHERE user_id = ? AND playlist_id = ?', (user_id, playlist_id))
+            conn.executemany(
+                'INSERT INTO playlist_tracks (user_id, playlist_id, track_id) VALUES (?, ?, ?)',
+                [(user_id, playlist_id, track_id) for track_id in set(track_ids)]
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO playlists (user_id, playlist_id, snapshot_id) VALUES (?, ?, ?)',
+                (user_id, playlist_id, snapshot_id)
+            )
+
+    def remove_playlists(self, user_id, playlist_ids):
+        """Drop playlists the user no longer has."""
+        with self._lock, _connect(self.path) as conn:
+            for playlist_id in playlist_ids:
+                conn.execute('DELETE FROM playlist_tracks WHERE user_id = ? AND playlist_id = ?', (user_id, playlist_id))
+                conn.execute('DELETE FROM playlists WHERE user_id = ? AND playlist_id = ?', (user_id, playlist_id))
+
+    def load_index(self, user_id):
+        """Return {track_id: set(playlist_ids)} for the user."""
+        index = defaultdict(set)
+        with self._lock, _connect(self.path) as conn:
+            rows = conn.execute('SELECT track_id, playlist_id FROM playlist_tracks WHERE user_id = ?', (user_id,))
+            for track_id, playlist_id in rows:
+                index[track_id].add(playlist_id)
+        return dict(index)
+
+class AudioFeaturesStore:
+    """Persistent map of track id to Spotify audio features, which never change for a track.
+
+    Tracks Spotify has no features for are remembered separately for missing_ttl seconds,
+    so they are not requested again on every pool build.
+    """
+
+    def __init__(self, path=None, missing_ttl=AUDIO_FEATURES_MISSING_TTL):
+        self.path = path or os.path.join(DATA_DIR, 'audio_features.sqlite3')
+        self.missing_ttl = missing_ttl
+        self._lock = threading.Lock()
+        with self._lock, _connect(self.path) as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS audio_features ('
+                'track_id TEXT PRIMARY KEY, features TEXT NOT NULL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS audio_features_missing ('
+                'track_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)'
+            )
+
+    def get_many(self, track_ids):
+        """Return {track_id: features} for the ids that are stored."""
+        found = {}
+        track_ids = list(track_ids)
+        with self._lock, _connect(self.path) as conn:
+            # Stay well below SQLite's bound-parameter limit
+            for i in range(0, len(track_ids), 500):
+                chunk = track_ids[i:i+500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f'SELECT track_id, features FROM audio_features WHERE track_id IN ({placeholders})', chunk)
+                for track_id, features in rows:
+                    found[track_id] = json.loads(features)
+        return found
+
+    def put_many(self, features_by_id):
+        """Store {track_id: features}, skipping tracks Spotify has no features for."""
+        rows = [(track_id, json.dumps(features)) for track_id, features in features_by_id.items() if features]
+        if not rows:
+            return
+        with self._lock, _connect(self.path) as conn:
+            conn.executemany('INSERT OR REPLACE INTO audio_features (track_id, features) VALUES (?, ?)', rows)
+
+    def get_missing(self, track_ids):
+        """Return the ids recently found to have no audio features."""
+        missing = set()
+        track_ids = list(track_ids)
+        now = time.time()
+        with self._lock, _connect(self.path) as conn:
+            for i in range(0, len(track_ids), 500):
+                chunk = track_ids[i:i+500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f'SELECT track_id FROM audio_features_missing WHERE track_id IN ({placeholders}) AND expires_at > ?',
+                    chunk + [now])
+                missing.update(track_id for track_id, in rows)
+        return missing
+
+    def put_missing(self, track_ids):
+        """Remember that Spotify returned no audio features for these ids."""
+        now = time.time()
+        rows = [(track_id, now + self.missing_ttl) for track_id in track_ids]
+        if not rows:
+            return
+        with self._lock, _connect(self.path) as conn:
+            conn.executemany('INSERT OR REPLACE INTO audio_features_missing (track_id, expires_at) VALUES (?, ?)', rows)
+            conn.execute('DELETE FROM audio_features_missing WHERE expires_at <= ?', (now,))
+
+class PoolStore:
+    """Per-session bulk data (track pools, recommendations, preference lists) kept out of the Flask session.
+
+    Values are msgpack-encoded with msgspec under (pool_id, name) and decoded into the type
+    the caller asks for. A pool expires ttl seconds after its last write, and the oldest
+    pools are dropped once the store grows past max_bytes.
+    """
+
+    def __init__(self, path=None, ttl=POOL_STORE_TTL, max_bytes=POOL_STORE_MAX_BYTES):
+        self.path = path or os.path.join(DATA_DIR, 'pools.sqlite3')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._encoder = msgspec.msgpack.Encoder()
+        with self._lock, _connect(self.path) as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS pool_data ('
+                'pool_id TEXT NOT NULL, name TEXT NOT NULL, data BLOB NOT NULL, '
+                'size INTEGER NOT NULL, expires_at REAL NOT NULL, '
+                'PRIMARY KEY (pool_id, name))'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS pool_data_by_expiry ON pool_data (expires_at)')
+
+    def get(self, pool_id, name, type=None, default=None):
+        """Return the stored value decoded as type, or default if it is missing or expired."""
+        if not pool_id:
+            return default
+        with self._lock, _connect(self.path) as conn:
+            row = conn.execute(
+                'SELECT data FROM pool_data WHERE pool_id = ? AND name = ? AND expires_at > ?',
+                (pool_id, name, time.time())).fetchone()
+        if row is None:
+            return default
+        try:
+            if type is None:
+                return msgspec.msgpack.decode(row[0])
+            return msgspec.msgpack.decode(row[0], type=type)
+        except msgspec.DecodeError as e:
+            logger.warning(f"Discarding unreadable pool data {name} for {pool_id}: {str(e)}")
+            return default
+
+    def put_many(self, pool_id, values):
+        """Store {name: value} for a pool and push the whole pool's expiry forward."""
+        expires_at = time.time() + self.ttl
+        rows = []
+        for name, value in values.items():
+            data = self._encoder.encode(value)
+            rows.append((pool_id, name, data, len(data), expires_at))
+        with self._lock, _connect(self.path) as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO pool_data (pool_id, name, data, size, expires_at) VALUES (?, ?, ?, ?, ?)', rows)
+            conn.execute('UPDATE pool_data SET expires_at = ? WHERE pool_id = ?', (expires_at, pool_id))
+            self._prune(conn, keep=pool_id)
+
+    def put(self, pool_id, name, value):
+        self.put_many(pool_id, {name: value})
+
+    def load(self, pool_id):
+        """Return every live value of a pool as plain data, e.g. for debug dumps."""
+        with self._lock, _connect(self.path) as conn:
+            rows = conn.execute(
+                'SELECT name, data FROM pool_data WHERE pool_id = ? AND expires_at > ?',
+                (pool_id, time.time())).fetchall()
+        return {name: msgspec.msgpack.decode(data) for name, data in rows}
+
+    def delete(self, pool_id):
+        with self._lock, _connect(self.path) as conn:
+            conn.execute('DELETE FROM pool_data WHERE pool_id = ?', (pool_id,))
+
+    def _prune(self, conn, keep=None):
+        """Drop expired data, then the least recently written pools until the store fits in max_bytes."""
+        conn.execute('DELETE FROM pool_data WHERE expires_at <= ?', (time.time(),))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM pool_data').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        pools = conn.execute(
+            'SELECT pool_id, SUM(size) FROM pool_data GROUP BY pool_id ORDER BY MAX(expires_at)').fetchall()
+        evicted = 0
+        for pool_id, size in pools:
+            if total <= self.max_bytes:
+                break
+            if pool_id == keep:
+                continue
+            conn.execute('DELETE FROM pool_data WHERE pool_id = ?', (pool_id,))
+            total -= size
+            evicted += 1
+        logger.info(f"Pool store over {self.max_bytes} bytes, evicted {evicted} pools")
+
+class RedisPoolStore:
+    """PoolStore on Redis, so a pool written on one host is readable from every other.
+
+    Each value is stored as msgpack bytes under pool:<pool_id>:<name> with a PX TTL, and a
+    hash at pool:<pool_id> records the size of each value. Every write pushes the whole
+    pool's expiry forward and a write that would take the pool past max_pool_bytes is
+    refused. Total memory is left to the Redis instance's maxmemory / LRU policy.
+    """
+
+    def __init__(self, client, ttl=POOL_STORE_TTL, max_pool_bytes=POOL_STORE_MAX_POOL_BYTES, prefix=REDIS_KEY_PREFIX):
+        self.client = client
+        self.ttl = ttl
+        self.max_pool_bytes = max_pool_bytes
+        self.prefix = prefix
+        self._encoder = msgspec.msgpack.Encoder()
+
+    def _index_key(self, pool_id):
+        return f"{self.prefix}pool:{pool_id}"
+
+    def _key(self, pool_id, name):
+        return f"{self.prefix}pool:{pool_id}:{name}"
+
+    def get(self, pool_id, name, type=None, default=None):
+        """Return the stored value decoded as type, or default if it is missing or expired."""
+        if not pool_id:
+            return default
+        try:
+            raw = self.client.get(self._key(pool_id, name))
+        except Exception as e:
+            logger.error(f"Could not read pool data {name} for {pool_id} from Redis: {str(e)}")
+            return default
+        if raw is None:
+            return default
+        try:
+            if type is None:
+                return msgspec.msgpack.decode(raw)
+            return msgspec.msgpack.decode(raw, type=type)
+        except msgspec.DecodeError as e:
+            logger.warning(f"Discarding unreadable pool data {name} for {pool_id}: {str(e)}")
+            return default
+
+    def put_many(self, pool_id, values):
+        """Store {name: value} for a pool and push the whole pool's expiry forward."""
+        encoded = {name: self._encoder.encode(value) for name, value in values.items()}
+        ttl_ms = int(self.ttl * 1000)
+        index_key = self._index_key(pool_id)
+        try:
+            sizes = {name.decode(): int(size) for name, size in self.client.hgetall(index_key).items()}
+            sizes.update({name: len(data) for name, data in encoded.items()})
+            total = sum(sizes.values())
+            if total > self.max_pool_bytes:
+                logger.error(f"Pool {pool_id} would hold {total} bytes, over the {self.max_pool_bytes} byte limit; not storing {list(encoded)}")
+                return
+            with self.client.pipeline() as pipe:
+                for name, data in encoded.items():
+                    pipe.set(self._key(pool_id, name), data, px=ttl_ms)
+                pipe.hset(index_key, mapping={name: len(data) for name, data in encoded.items()})
+                for name in sizes:
+                    if name not in encoded:
+                        pipe.pexpire(self._key(pool_id, name), ttl_ms)
+                pipe.pexpire(index_key, ttl_ms)
+                pipe.execute()
+        except Exception as e:
+            logger.error(f"Could not write pool data {list(encoded)} for {pool_id} to Redis: {str(e)}")
+
+    def put(self, pool_id, name, value):
+        self.put_many(pool_id, {name: value})
+
+    def load(self, pool_id):
+        """Return every live value of a pool as plain data, e.g. for debug dumps."""
+        names = [name.decode() for name in self.client.hkeys(self._index_key(pool_id))]
+        values = self.client.mget([self._key(pool_id, name) for name in names]) if names else []
+        return {name: msgspec.msgpack.decode(raw) for name, raw in zip(names, values) if raw is not None}
+
+    def delete(self, pool_id):
+        try:
+            names = [name.decode() for name in self.client.hkeys(self._index_key(pool_id))]
+            self.client.delete(self._index_key(pool_id), *[self._key(pool_id, name) for name in names])
+        except Exception as e:
+            logger.error(f"Could not delete pool {pool_id} from Redis: {str(e)}")
+
+def build_pool_store(redis_client=None):
+    """Build the pool store: on Redis when it is configured and reachable, so every host sees
+    the same pools, otherwise in a local SQLite file."""
+    redis_client = redis_client or connect_redis()
+    if redis_client is not None:
+        logger.info("Using Redis-backed pool store")
+        return RedisPoolStore(redis_client)
+    return PoolStore()
+
+class TrackResolutionStore:
+    """Cross-user map of normalized (title, artist) to the Spotify track id a search resolved it to.
+
+    Each entry records which query matched ('exact' or 'relaxed'); misses are stored as
+    'not_found' with no id and expire sooner, so new releases are picked up.
+
+    When a cache is given (the helpers' tiered cache), it is the first tier: writes go to
+    both, and SQLite hits are copied into the cache for their remaining lifetime, so
+    workers on other hosts share resolutions through Redis while SQLite keeps them
+    across restarts.
+    """
+
+    def __init__(self, path=None, ttl=RESOLUTION_CACHE_TTL, not_found_ttl=RESOLUTION_NOT_FOUND_TTL, cache=None):
+        self.path = path or os.path.join(DATA_DIR, 'track_resolutions.sqlite3')
+        self.cache = cache
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self._lock = threading.Lock()
+        with self._lock, _connect(self.path) as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS track_resolutions ('
+                'title TEXT NOT NULL, artist TEXT NOT NULL, track_id TEXT, match TEXT NOT NULL, '
+                'expires_at REAL NOT NULL, PRIMARY KEY (title, artist))'
+            )
+
+    def get_many(self, keys):
+        """Return {(title, artist): (track_id, match)} for the keys with a live entry."""
+        found = {}
+        missing = set(keys)
+        if self.cache is not None:
+            for key in list(missing):
+                entry = self.cache.get(key, namespace='resolutions', default=None)
+                if entry is not None:
+                    found[key] = tuple(entry)
+                    missing.discard(key)
+        if not missing:
+            return found
+
+        now = time.time()
+        with self._lock, _connect(self.path) as conn:
+            for title, artist in missing:
+                row = conn.execute(
+                    'SELECT track_id, match, expires_at FROM track_resolutions WHERE title = ? AND artist = ? AND expires_at > ?',
+                    (title, artist, now)).fetchone()
+                if row is not None:
+                    track_id, match, expires_at = row
+                    found[(title, artist)] = (track_id, match)
+                    if self.cache is not None:
+                        self.cache.set((title, artist), [track_id, match], ttl=expires_at - now, namespace='resolutions')
+        return found
+
+    def put_many(self, resolutions):
+        """Store {(title, artist): (track_id, match)}."""
+        now = time.time()
+        rows = [
+            (title, artist, track_id, match, now + (self.not_found_ttl if match == 'not_found' else self.ttl))
+            for (title, artist), (track_id, match) in resolutions.items()
+        ]
+        if not rows:
+            return
+        if self.cache is not None:
+            for title, artist, track_id, match, expires_at in rows:
+                self.cache.set((title, artist), [track_id, match], ttl=expires_at - now, namespace='resolutions')
+        with self._lock, _connect(self.path) as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO track_resolutions (title, artist, track_id, match, expires_at) VALUES (?, ?, ?, ?, ?)', rows)
+            conn.execute('DELETE FROM track_resolutions WHERE expires_at <= ?', (now,))
@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+from caching import TTLCache, RedisCache, TieredCache, MISSING
+
+fakeredis = pytest.importorskip('fakeredis')
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis()
+
+def test_redis_cache_round_trip(redis_client):
+    cache = RedisCache(redis_client, prefix='test:')
+    value = {'id': 'abc', 'artists': [{'name': 'Band'}], 'popularity': 42}
+    cache.set('track', value, ttl=60, namespace='tracks')
+
+    assert cache.get('track', namespace='tracks') == value
+    assert cache.get('track', namespace='other') is MISSING
+    assert 0 < cache.ttl_remaining('track', namespace='tracks') <= 60
+
+def test_redis_cache_expires(redis_client):
+    cache = RedisCache(redis_client, prefix='test:')
+    cache.set('key', 'value', ttl=0.1)
+    time.sleep(0.2)
+    assert cache.get('key') is MISSING
+
+def test_tiered_cache_shares_values_between_workers(redis_client):
+    first = TieredCache(TTLCache(), RedisCache(redis_client, prefix='test:'))
+    second = TieredCache(TTLCache(), RedisCache(redis_client, prefix='test:'))
+    first.set('profile', {'id': 'user'}, ttl=60, namespace='profiles')
+
+    assert second.get('profile', namespace='profiles') == {'id': 'user'}
+    # The copy now sits in the second worker's local tier
+    assert second.local.get('profile', namespace='profiles') == {'id': 'user'}
+
+def test_tiered_cache_local_copy_never_outlives_redis(redis_client):
+    shared = RedisCache(redis_client, prefix='test:')
+    first = TieredCache(TTLCache(), shared)
+    second = TieredCache(TTLCache(), shared, local_max_ttl=60)
+    first.set('key', 'value', ttl=0.2)
+    assert second.get('key') == 'value'
+
+    time.sleep(0.3)
+    assert second.get('key') is MISSING
+    assert first.get('key') is MISSING
+
+def test_tiered_cache_delete_clears_both_tiers(redis_client):
+    cache = TieredCache(TTLCache(), RedisCache(redis_client, prefix='test:'))
+    cache.set('key', 'value', ttl=60)
+    cache.delete('key')
+    assert cache.local.get('key') is MISSING
+    assert cache.shared.get('key') is MISSING
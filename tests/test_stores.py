@@ -0,0 +1,44 @@
+from typing import List
+
+import pytest
+
+from records import TrackRecord
+from stores import RedisPoolStore
+
+fakeredis = pytest.importorskip('fakeredis')
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis()
+
+def test_redis_pool_store_shared_between_hosts(redis_client):
+    first = RedisPoolStore(redis_client, prefix='test:')
+    second = RedisPoolStore(redis_client, prefix='test:')
+    pool = [TrackRecord(id='t1', name='Song', artist_names=['Band'], artist_ids=['a1'])]
+    first.put_many('p1', {'track_pool': pool, 'explanation': 'why'})
+
+    assert second.get('p1', 'track_pool', type=List[TrackRecord]) == pool
+    assert second.get('p1', 'explanation') == 'why'
+    assert second.get('p1', 'missing', default=[]) == []
+    assert set(second.load('p1')) == {'track_pool', 'explanation'}
+
+def test_redis_pool_store_refreshes_expiry_of_whole_pool(redis_client):
+    store = RedisPoolStore(redis_client, ttl=60, prefix='test:')
+    store.put('p1', 'track_pool', [1, 2, 3])
+    redis_client.pexpire('test:pool:p1:track_pool', 1000)
+    store.put('p1', 'explanation', 'why')
+    assert redis_client.pttl('test:pool:p1:track_pool') > 1000
+
+def test_redis_pool_store_refuses_oversized_pool(redis_client):
+    store = RedisPoolStore(redis_client, max_pool_bytes=100, prefix='test:')
+    store.put('p1', 'small', 'x')
+    store.put('p1', 'big', 'x' * 200)
+    assert store.get('p1', 'small') == 'x'
+    assert store.get('p1', 'big') is None
+
+def test_redis_pool_store_delete(redis_client):
+    store = RedisPoolStore(redis_client, prefix='test:')
+    store.put('p1', 'track_pool', [1])
+    store.delete('p1')
+    assert store.get('p1', 'track_pool') is None
+    assert redis_client.keys('test:*') == []